@@ -2,22 +2,85 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import json
+import ast
+import hashlib
+import csv
+import io
+import tempfile
 import re
+import unicodedata
 import logging
+import logging.handlers
+import queue
+import atexit
 from datetime import datetime
 import os
 import sys
 import dotenv
 from dotenv import load_dotenv
 import asyncio
+import heapq
+import itertools
 import time
 import sqlite3
 from sqlite3 import Error
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import functools
+import threading
+import traceback
+from aiohttp import web
 
-# Configuración de logging
-logging.basicConfig(level=logging.DEBUG, filename='bot.log', filemode='a', format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
 
+# Configuración de logging
+class FormatoJSON(logging.Formatter):
+    """Una linea JSON por registro, con la sesion y el miembro cuando se pasan en extra."""
+
+    CAMPOS_EXTRA = ("sesion", "miembro")
+
+    def format(self, record):
+        datos = {
+            "momento": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        for campo in self.CAMPOS_EXTRA:
+            if hasattr(record, campo):
+                datos[campo] = getattr(record, campo)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+def configurar_logging():
+    """
+    Los registros se encolan desde cualquier hilo y un QueueListener los escribe en su propio
+    hilo, asi el bucle de eventos nunca espera a disco. El fichero rota por tamaño (o cada dia
+    con LOG_ROTATION='diaria') y la consola conserva el formato legible de siempre.
+    """
+    ruta = os.getenv("LOG_FILE") or "bot.log"
+    if os.getenv("LOG_ROTATION", "").lower() == "diaria":
+        fichero = logging.handlers.TimedRotatingFileHandler(ruta, when="midnight", backupCount=int(os.getenv("LOG_BACKUPS") or 7), encoding="utf-8")
+    else:
+        fichero = logging.handlers.RotatingFileHandler(ruta, maxBytes=int(os.getenv("LOG_MAX_BYTES") or 10 * 1024 * 1024),
+                                                       backupCount=int(os.getenv("LOG_BACKUPS") or 5), encoding="utf-8")
+    fichero.setFormatter(FormatoJSON())
+    consola = logging.StreamHandler(sys.stdout)
+    consola.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    cola = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    raiz.handlers = [logging.handlers.QueueHandler(cola)]
+    raiz.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logging.getLogger("discord").setLevel(os.getenv("LOG_LEVEL_DISCORD", "WARNING").upper())
+
+    listener = logging.handlers.QueueListener(cola, fichero, consola, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Vaciar la cola al salir
+    return listener
+
+configurar_logging()
+log = logging.getLogger("eventos")
+
 # Lista de claves requeridas
 required_keys = [
     "DISCORD_TOKEN", "APPLICATION_ID", "CHANNEL_DEFAULT", "CHANNEL_ADMIN", "THREAD_STATS_NAME", "ROL_JUGADORES",
@@ -26,7 +89,7 @@ required_keys = [
 # Verificar que todas las claves existen y tienen valor
 missing_keys = [key for key in required_keys if not os.environ.get(key)]
 if missing_keys:
-    print(f"Error: Faltan los siguientes parametros por configurar: {', '.join(missing_keys)}")
+    log.error("Faltan los siguientes parametros por configurar: %s", ", ".join(missing_keys))
     sys.exit(1)  # Salir del script con error
 
 # Si todas las claves están presentes, cargar la configuración
@@ -40,10 +103,26 @@ config = {
 discord.VoiceClient.warn_nacl = False
 intents = discord.Intents.default()
 intents.members = True  # Necesario para fetch_members()
-intents.message_content = True
-client = discord.Client(intents=intents)
+intents.message_content = True  # Los comandos con prefijo necesitan leer el mensaje
 application_id = int(config['application_id'])
-bot = commands.Bot(command_prefix='/', intents=intents, application_id=application_id)
+opciones_bot = {"command_prefix": '/', "intents": intents, "application_id": application_id}
+# Modo ligero para guilds grandes: sin descargar todos los miembros al arrancar y guardando en cache
+# solo a los conectados a voz; los nombres escritos en las listas se buscan en Discord cuando hacen
+# falta y los jugadores encontrados se guardan en el indice de nombres, que tiene tamaño maximo
+MODO_LIGERO = os.getenv("LEAN_MEMBERS", "false").lower() == "true"
+if MODO_LIGERO:
+    cache_miembros = discord.MemberCacheFlags.none()
+    cache_miembros.voice = True
+    opciones_bot.update(chunk_guilds_at_startup=False, member_cache_flags=cache_miembros)
+# Con muchos servidores los guilds se reparten entre varias conexiones al gateway (shards); con
+# SHARD_COUNT vacio Discord decide cuantas
+MODO_SHARDS = os.getenv("SHARDING", "false").lower() == "true"
+if MODO_SHARDS:
+    if os.getenv("SHARD_COUNT"):
+        opciones_bot["shard_count"] = int(os.environ["SHARD_COUNT"])
+    bot = commands.AutoShardedBot(**opciones_bot)
+else:
+    bot = commands.Bot(**opciones_bot)
 
 # Variables globales
 ROL_ID_JUGADORES = int(os.environ['ROL_JUGADORES'])
@@ -54,96 +133,1408 @@ MAX_JUGADORES = int(os.environ['MAX_PLAYERS'])
 MAX_JUGADORES_LISTAS = MAX_JUGADORES * 2
 MAX_TIME_LIST = int(os.environ['MAX_TIME'])
 THREAD_STATS_NAME = os.environ['THREAD_STATS_NAME']
-miembros_lista = {}
-miembros_objetos = {}
-embed_main_message = None
-embed_reservas_message = None
-lista_cerrada = True
-tarea_cerrar_lista = None
-tiempo_inicio_lista = None
+# Canales donde se pueden abrir listas: el de por defecto y, opcionalmente, otros separados por comas
+CANALES_EVENTOS = [int(config['channel_default'])] + [int(c) for c in os.getenv("EXTRA_CHANNELS", "").split(",") if c.strip()]
 send_messages = os.getenv("SEND_MESSAGES", "true").lower() == "true"
-adding_players = set()
-adding_lock = asyncio.Lock()
-ultima_actualizacion_embed = 0  # Timestamp de la última actualización del embed
-embed_update_lock = asyncio.Lock()  # Bloqueo para controlar actualizaciones del embed
+export_stats_on_close = os.getenv("EXPORT_STATS_ON_CLOSE", "false").lower() == "true"
+# Cada cuantos segundos se refresca la cuenta atras del embed (0 para no hacerlo) y a cuantos
+# segundos del cierre se recuerda por privado a los desconectados que se conecten
+INTERVALO_CUENTA_ATRAS = int(os.getenv("COUNTDOWN_REFRESH") or 60)
+RECORDATORIOS = sorted((int(r) for r in os.getenv("REMINDERS", "").split(",") if r.strip()), reverse=True)
+bot_inicializado = False
+
+#################################################################################################
+
+class Metricas:
+    """
+    Contadores e histogramas del bot, en memoria, para /metrics y el comando Metrics.
+
+    Con las metricas desactivadas contar() y observar() vuelven en la primera linea, y ni el
+    endpoint ni la medicion de los eventos del gateway se ponen en marcha.
+    """
+
+    LIMITES = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Segundos
+
+    def __init__(self, activas):
+        self.activas = activas
+        self.contadores = {}  # (nombre, etiquetas) -> valor
+        self.histogramas = {}  # (nombre, etiquetas) -> [cuentas por limite..., +Inf, suma]
+        self.lock = threading.Lock()  # Las consultas se miden tambien desde el hilo de la base de datos
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        if not self.activas:
+            return
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self.lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, segundos, **etiquetas):
+        if not self.activas:
+            return
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self.lock:
+            histograma = self.histogramas.get(clave)
+            if histograma is None:
+                histograma = self.histogramas[clave] = [0] * (len(self.LIMITES) + 2)
+            for i, limite in enumerate(self.LIMITES):
+                if segundos <= limite:
+                    histograma[i] += 1
+                    break
+            else:
+                histograma[len(self.LIMITES)] += 1
+            histograma[-1] += segundos
+
+    def percentil(self, histograma, p):
+        """Limite superior del cubo en el que cae el percentil p (aproximado, como en Prometheus)."""
+        total = sum(histograma[:-1])
+        acumulado = 0
+        for i, cuenta in enumerate(histograma[:-1]):
+            acumulado += cuenta
+            if total and acumulado >= total * p:
+                return self.LIMITES[i] if i < len(self.LIMITES) else float("inf")
+        return 0.0
+
+    def texto_prometheus(self):
+        def etiquetas_texto(etiquetas, extra=()):
+            pares = list(etiquetas) + list(extra)
+            return "{" + ",".join(f'{clave}="{valor}"' for clave, valor in pares) + "}" if pares else ""
+
+        lineas = []
+        with self.lock:
+            contadores = sorted(self.contadores.items())
+            histogramas = sorted((clave, list(valores)) for clave, valores in self.histogramas.items())
+        tipos = set()
+        for (nombre, etiquetas), valor in contadores:
+            if nombre not in tipos:
+                tipos.add(nombre)
+                lineas.append(f"# TYPE bot_eventos_{nombre} counter")
+            lineas.append(f"bot_eventos_{nombre}{etiquetas_texto(etiquetas)} {valor}")
+        for (nombre, etiquetas), histograma in histogramas:
+            if nombre not in tipos:
+                tipos.add(nombre)
+                lineas.append(f"# TYPE bot_eventos_{nombre} histogram")
+            acumulado = 0
+            for limite, cuenta in zip(self.LIMITES + ("+Inf",), histograma[:-1]):
+                acumulado += cuenta
+                lineas.append(f"bot_eventos_{nombre}_bucket{etiquetas_texto(etiquetas, [('le', limite)])} {acumulado}")
+            lineas.append(f"bot_eventos_{nombre}_sum{etiquetas_texto(etiquetas)} {histograma[-1]}")
+            lineas.append(f"bot_eventos_{nombre}_count{etiquetas_texto(etiquetas)} {acumulado}")
+        return "\n".join(lineas) + "\n"
+
+metricas = Metricas(os.getenv("METRICS", "false").lower() == "true")
+PUERTO_METRICAS = int(os.getenv("METRICS_PORT") or 0)  # 0: sin endpoint /metrics
+
+def medir_evento(funcion):
+    """Mide cuanto tarda un manejador de eventos del gateway. Sin metricas no lo envuelve."""
+    if not metricas.activas:
+        return funcion
+
+    @functools.wraps(funcion)
+    async def medido(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return await funcion(*args, **kwargs)
+        finally:
+            metricas.observar("evento_segundos", time.perf_counter() - inicio, evento=funcion.__name__)
+    return medido
+
+class RegistroLimitesDiscord(logging.Handler):
+    """
+    Cuenta los 429, el tiempo de espera que piden y los buckets agotados que discord.http anota en su log.
+
+    Discord.py solo avisa de los buckets agotados (las esperas preventivas) en DEBUG, asi que el logger
+    se pone en DEBUG y deja de propagar; este handler reenvia al resto del log solo lo que llega al
+    nivel que el logger tenia configurado.
+    """
+
+    def __init__(self, logger):
+        super().__init__()
+        self.nivel = logger.getEffectiveLevel()
+        self.padre = logger.parent
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(self)
+
+    def emit(self, record):
+        mensaje = record.msg
+        if mensaje.startswith("We are being rate limited"):
+            metricas.contar("respuestas_429_total")
+            # Si la espera es demasiado larga discord.py lanza RateLimited en vez de esperar
+            if "erroring instead" not in mensaje and len(record.args) >= 3:
+                metricas.contar("espera_limite_segundos_total", record.args[2])
+        elif "has been exhausted" in mensaje:
+            metricas.contar("limites_agotados_total")
+        if record.levelno >= self.nivel:
+            self.padre.handle(record)
+
+class VigilanteBucle:
+    """
+    Detecta bloqueos del bucle de eventos y captura donde estaba parado.
+
+    Una tarea late cada `intervalo` segundos y anota el retraso con el que despierta. Un hilo
+    aparte comprueba los latidos: si el bucle lleva mas de `umbral` segundos sin latir, copia
+    la pila del hilo del bucle y el nombre de la tarea que se esta ejecutando (discord.py llama
+    a las suyas "discord.py: on_<evento>") y la escribe en el log mientras sigue bloqueado.
+    """
+
+    def __init__(self, umbral, intervalo=0.1):
+        self.umbral = umbral
+        self.intervalo = intervalo
+        self.loop = None
+        self.hilo_bucle = None
+        self.ultimo_latido = time.monotonic()
+        self.bloqueado_en = None  # Tarea en la que el hilo vigilante ha visto el ultimo bloqueo
+
+    def iniciar(self):
+        if not self.umbral and not metricas.activas:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.hilo_bucle = threading.get_ident()
+        self.loop.create_task(self._latir())
+        if self.umbral:
+            threading.Thread(target=self._vigilar, name="vigilante-bucle", daemon=True).start()
+
+    async def _latir(self):
+        while True:
+            self.ultimo_latido = inicio = time.monotonic()
+            await asyncio.sleep(self.intervalo)
+            retraso = max(0.0, time.monotonic() - inicio - self.intervalo)
+            metricas.observar("retraso_bucle_segundos", retraso)
+            if self.bloqueado_en is not None:
+                log.warning("El bucle de eventos ha estado bloqueado %.0f ms en %s", retraso * 1000, self.bloqueado_en)
+                metricas.contar("bloqueos_bucle_total")
+                self.bloqueado_en = None
+
+    def _tarea_actual(self):
+        tarea = asyncio.current_task(self.loop)
+        if tarea is None:
+            return "un callback fuera de tarea"
+        return f"{tarea.get_name()} ({tarea.get_coro().__qualname__})"
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.intervalo / 2)
+            parado = time.monotonic() - self.ultimo_latido - self.intervalo
+            if parado < self.umbral or self.bloqueado_en is not None:
+                continue
+            frame = sys._current_frames().get(self.hilo_bucle)
+            pila = "".join(traceback.format_stack(frame)) if frame is not None else "(pila no disponible)"
+            self.bloqueado_en = self._tarea_actual()
+            log.warning("Bucle de eventos bloqueado más de %.0f ms en %s:\n%s", parado * 1000, self.bloqueado_en, pila)
+
+vigilante_bucle = VigilanteBucle(int(os.getenv("LOOP_STALL_MS") or 500) / 1000)
+
+async def iniciar_metricas():
+    if not metricas.activas:
+        return
+    RegistroLimitesDiscord(logging.getLogger("discord.http"))
+    if not PUERTO_METRICAS:
+        return
+
+    async def servir_metricas(request):
+        return web.Response(text=metricas.texto_prometheus(), content_type="text/plain", charset="utf-8")
+
+    aplicacion = web.Application()
+    aplicacion.router.add_get("/metrics", servir_metricas)
+    runner = web.AppRunner(aplicacion, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, os.getenv("METRICS_HOST", "127.0.0.1"), PUERTO_METRICAS).start()
+    log.info("Métricas disponibles en http://%s:%s/metrics", os.getenv("METRICS_HOST", "127.0.0.1"), PUERTO_METRICAS)
 
 #################################################################################################
 
 # Obtén la ruta del directorio donde se encuentra el script
 current_directory = os.path.dirname(os.path.abspath(__file__))
-# Ruta completa del archivo de base de datos
-database_file = os.path.join(current_directory, "control_eventos.db")
+# Ruta completa del archivo de base de datos (DATABASE_FILE permite usar otra, por ejemplo en el simulador)
+database_file = os.getenv("DATABASE_FILE") or os.path.join(current_directory, "control_eventos.db")
 
-def sql_connection():
-    try:
-        con = sqlite3.connect(database_file)
+class BaseDatos:
+    """
+    Conexion persistente a SQLite que trabaja en un hilo dedicado.
+
+    Todas las consultas se ejecutan en un ThreadPoolExecutor de un unico hilo, de modo que el
+    bucle de eventos nunca espera a disco y la conexion nunca se comparte entre hilos. La
+    conexion se abre una sola vez en modo WAL y guarda el tiempo de cada consulta.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL;",
+        "PRAGMA synchronous=NORMAL;",
+        "PRAGMA temp_store=MEMORY;",
+        "PRAGMA cache_size=-8000;",
+        "PRAGMA busy_timeout=5000;",
+        "PRAGMA foreign_keys=ON;",
+    )
+    UMBRAL_CONSULTA_LENTA = 0.1  # Segundos a partir de los cuales se avisa de una consulta lenta
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.con = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.tiempos = {}  # consulta -> [ejecuciones, tiempo total, tiempo maximo]
+        self.lock_tiempos = threading.Lock()  # Se escriben en el hilo de la base de datos y se leen en el bucle
+
+    def _conectar(self):
+        # isolation_level=None: cada sentencia suelta se confirma sola y las transacciones
+        # se abren de forma explicita en transaccion()
+        con = sqlite3.connect(self.ruta, isolation_level=None, check_same_thread=False, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            con.execute(pragma)
         return con
-    except sqlite3.Error as error:
-        print(f"Error al conectar a la base de datos: {error}")
-        return None
 
-def sql_fetch(query, params=None):
-    con = None
+    def _medir(self, etiqueta, funcion):
+        if self.con is None:
+            self.con = self._conectar()
+        inicio = time.perf_counter()
+        try:
+            return funcion(self.con)
+        finally:
+            duracion = time.perf_counter() - inicio
+            with self.lock_tiempos:
+                estadistica = self.tiempos.setdefault(etiqueta, [0, 0.0, 0.0])
+                estadistica[0] += 1
+                estadistica[1] += duracion
+                estadistica[2] = max(estadistica[2], duracion)
+            if duracion >= self.UMBRAL_CONSULTA_LENTA:
+                log.warning("Consulta lenta (%.1f ms): %s", duracion * 1000, etiqueta)
+
+    async def _ejecutar(self, etiqueta, funcion):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._medir, etiqueta, funcion)
+
+    async def ejecutar(self, funcion, etiqueta):
+        """Ejecuta funcion(con) en el hilo de la base de datos, fuera de cualquier transaccion explicita."""
+        return await self._ejecutar(etiqueta, funcion)
+
+    async def fetch(self, query, params=None):
+        return await self._ejecutar(" ".join(query.split()), lambda con: con.execute(query, params or ()).fetchall())
+
+    async def update(self, query, params=None):
+        return await self._ejecutar(" ".join(query.split()), lambda con: con.execute(query, params or ()).rowcount)
+
+    async def transaccion(self, funcion, etiqueta=None):
+        """
+        Ejecuta funcion(con) dentro de una unica transaccion (un solo commit y un solo fsync).
+        Si la funcion lanza una excepcion se deshace todo.
+        """
+        def ejecutar(con):
+            con.execute("BEGIN IMMEDIATE;")
+            try:
+                resultado = funcion(con)
+            except BaseException:
+                con.execute("ROLLBACK;")
+                raise
+            con.execute("COMMIT;")
+            return resultado
+
+        return await self._ejecutar(etiqueta or f"transaccion:{funcion.__name__}", ejecutar)
+
+    def estadisticas(self):
+        """Devuelve [(consulta, ejecuciones, media_ms, max_ms)] ordenado por tiempo total."""
+        with self.lock_tiempos:
+            filas = sorted(((consulta, tuple(valores)) for consulta, valores in self.tiempos.items()), key=lambda item: item[1][1], reverse=True)
+        return [(consulta, n, total / n * 1000, maximo * 1000) for consulta, (n, total, maximo) in filas]
+
+    def cerrar(self):
+        def cerrar_conexion():
+            if self.con is not None:
+                self.con.execute("PRAGMA optimize;")
+                self.con.close()
+                self.con = None
+        self.executor.submit(cerrar_conexion).result()
+        self.executor.shutdown(wait=True)
+
+db = BaseDatos(database_file)
+
+async def sql_fetch(query, params=None):
+    inicio = time.perf_counter()
     try:
-        con = sql_connection()
-        if not con:
-            raise sqlite3.Error("No se pudo establecer la conexión a la base de datos")
-        cursor = con.cursor()
-        cursor.execute(query, params or ())
-        result = cursor.fetchall()
-        cursor.close()
-        return result
+        return await db.fetch(query, params)
     except sqlite3.Error as error:
-        print(f"Error al ejecutar consulta de lectura: {error}")
+        log.error("Error al ejecutar consulta de lectura: %s", error)
         return []
     finally:
-        if con:
-            con.close()
+        metricas.observar("sql_segundos", time.perf_counter() - inicio, operacion="fetch")
 
-def sql_update(query, params=None):
-    con = None
+async def sql_update(query, params=None):
+    inicio = time.perf_counter()
     try:
-        con = sql_connection()
-        if not con:
-            raise sqlite3.Error("No se pudo establecer la conexión a la base de datos")
-        cursor = con.cursor()
-        cursor.execute(query, params or ())
-        con.commit()
-        cursor.close()
+        return await db.update(query, params)
     except sqlite3.Error as error:
-        print(f"Error al ejecutar consulta de actualización: {error}")
+        log.error("Error al ejecutar consulta de actualización: %s", error)
+    finally:
+        metricas.observar("sql_segundos", time.perf_counter() - inicio, operacion="update")
+
+async def sql_transaccion(funcion, etiqueta=None):
+    inicio = time.perf_counter()
+    try:
+        return await db.transaccion(funcion, etiqueta)
+    except sqlite3.Error as error:
+        log.error("Error al ejecutar transacción: %s", error)
+        return None
     finally:
-        if con is not None:  # Añadir esta verificación
-            con.close()
+        metricas.observar("sql_segundos", time.perf_counter() - inicio, operacion="transaccion")
+
+def fix_json(json_str):
+    """
+    Lee el DatosLista de una lista. Las versiones antiguas guardaban el repr de un dict de
+    Python (comillas simples), por lo que si no es JSON valido se intenta repararlo.
+    """
+    try:
+        return json.loads(json_str)
+    except json.JSONDecodeError:
+        pass
+    try:
+        datos = ast.literal_eval(json_str)
+        if isinstance(datos, dict):
+            return datos
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        return json.loads(re.sub(r"(?<!\\)'", '"', json_str))
+    except json.JSONDecodeError as e:
+        log.error("Error al reparar JSON: %s, Error: %s", json_str, e)
+        raise
+
+def filas_lista_jugadores(id_lista, jugadores, max_jugadores):
+    """
+    Convierte los jugadores de una lista en filas de ListaJugadores.
+
+    Args:
+        jugadores (list): Tuplas (nombre, estado, IdDiscord) en orden; IdDiscord es None si no se identifico.
+
+    Returns:
+        list: Tuplas (idLista, Posicion, IdDiscord, Nombre, Reserva, Estado).
+    """
+    return [
+        (id_lista, posicion, id_discord, nombre, 1 if posicion > max_jugadores else 0, estado)
+        for posicion, (nombre, estado, id_discord) in enumerate(jugadores, 1)
+    ]
+
+def insert_lista_jugadores(con, filas):
+    con.executemany(
+        "INSERT INTO ListaJugadores (idLista, Posicion, IdDiscord, Nombre, Reserva, Estado) VALUES (?, ?, ?, ?, ?, ?);",
+        filas
+    )
+
+def migrar_datos_lista(con):
+    """
+    Migracion unica: pasa los DatosLista ya guardados a ListaJugadores. El IdDiscord se deduce
+    del Apodo o UserDiscord de Jugadores; si no coincide ninguno se deja a NULL.
+    """
+    ids_discord = {}
+    for id_discord, user_discord, apodo in con.execute("SELECT IdDiscord, UserDiscord, Apodo FROM Jugadores;"):
+        for nombre in (user_discord, apodo):
+            if nombre:
+                ids_discord.setdefault(nombre, id_discord)
+
+    for id_lista, datos_lista, num_jugadores in con.execute("SELECT idLista, DatosLista, NumJugadores FROM Listas;").fetchall():
+        try:
+            miembros = fix_json(datos_lista)
+        except json.JSONDecodeError:
+            log.warning("No se pudo migrar la lista %s: Datos inválidos.", id_lista)
+            continue
+        jugadores = [(nombre, estado, ids_discord.get(nombre)) for nombre, estado in miembros.items()]
+        insert_lista_jugadores(con, filas_lista_jugadores(id_lista, jugadores, num_jugadores or MAX_JUGADORES))
+
+VENTANA_HISTORIAL = 20  # Ultimas listas de cada jugador que se guardan en HistorialJugadores
+
+def actualizar_historial(con, filas):
+    """
+    Suma una lista al historial de asistencia de cada jugador con un unico INSERT ... ON CONFLICT DO UPDATE,
+    asi el historial se mantiene al cerrar cada lista sin volver a leer las anteriores.
+
+    Args:
+        filas (list): Tuplas (IdDiscord, idLista, FechaLista, asistio) en el orden en que se cerraron las listas.
+    """
+    query = f'''
+        INSERT INTO HistorialJugadores (IdDiscord, Listas, Asistencias, Ventana, RachaAsistencias, RachaAusencias, UltimaLista, UltimaAsistencia)
+        VALUES (?1, 1, ?4, CAST(?4 AS TEXT), ?4, 1 - ?4, ?2, CASE WHEN ?4 = 1 THEN ?3 END)
+        ON CONFLICT(IdDiscord) DO UPDATE SET
+            Listas = Listas + 1,
+            Asistencias = Asistencias + excluded.Asistencias,
+            Ventana = substr(Ventana || excluded.Ventana, -{VENTANA_HISTORIAL}),
+            RachaAsistencias = CASE WHEN excluded.Asistencias = 1 THEN RachaAsistencias + 1 ELSE 0 END,
+            RachaAusencias = CASE WHEN excluded.Asistencias = 1 THEN 0 ELSE RachaAusencias + 1 END,
+            UltimaLista = excluded.UltimaLista,
+            UltimaAsistencia = COALESCE(excluded.UltimaAsistencia, UltimaAsistencia);
+    '''
+    con.executemany(query, filas)
+
+def reconstruir_historial(con):
+    """
+    Rehace HistorialJugadores desde ListaJugadores, repasando las listas en el orden en que se cerraron.
+    Los jugadores que no se identificaron (IdDiscord NULL) no tienen historial.
+    """
+    con.execute("DELETE FROM HistorialJugadores;")
+    filas = con.execute('''
+        SELECT lj.IdDiscord, lj.idLista, l.FechaLista, lj.Estado IN ('si', 'sí')
+        FROM ListaJugadores lj JOIN Listas l ON l.idLista = lj.idLista
+        WHERE lj.IdDiscord IS NOT NULL
+        ORDER BY lj.idLista, lj.Posicion;
+    ''')
+    actualizar_historial(con, filas)
+    return con.execute("SELECT COUNT(*) FROM HistorialJugadores;").fetchone()[0]
+
+FORMATO_DATOS_ACTUAL = 1  # DatosLista en JSON canonico, tal como lo escribe json.dumps
+
+# Migraciones del esquema. La posicion en la lista es la version (PRAGMA user_version) que deja
+# aplicada la base de datos; solo se ejecutan las que faltan.
+MIGRACIONES = [
+    # 1: porcentajes calculados al leer en lugar de recalcularlos para todos los jugadores en cada cierre
+    (
+        """
+        CREATE VIEW IF NOT EXISTS VistaJugadores AS
+        SELECT j.IdDiscord, j.UserDiscord, j.Apodo, j.PartidasInscrito, j.PartidasConectado, j.PartidasDesconectado,
+               CASE WHEN t.total > 0 THEN ROUND(j.PartidasInscrito * 100.0 / t.total, 2) ELSE 0 END AS PorcentajeInscrito,
+               CASE WHEN j.PartidasInscrito > 0 THEN ROUND(j.PartidasDesconectado * 100.0 / j.PartidasInscrito, 2) ELSE 0 END AS PorcentajeAusencias,
+               j.UltimaPartida
+        FROM Jugadores j,
+             (SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'Listas'), 0) AS total) t;
+        """,
+    ),
+    # 2: jugadores de cada lista en una tabla normalizada en lugar de solo el JSON de DatosLista
+    (
+        """
+        CREATE TABLE IF NOT EXISTS ListaJugadores (
+            idLista INTEGER NOT NULL REFERENCES Listas (idLista) ON DELETE CASCADE,
+            Posicion INTEGER NOT NULL,
+            IdDiscord INTEGER,
+            Nombre TEXT NOT NULL,
+            Reserva INTEGER NOT NULL DEFAULT 0,
+            Estado TEXT NOT NULL,
+            PRIMARY KEY (idLista, Posicion)
+        ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ListaJugadores_IdDiscord ON ListaJugadores (IdDiscord, idLista);",
+        "CREATE INDEX IF NOT EXISTS idx_ListaJugadores_Nombre ON ListaJugadores (Nombre, idLista);",
+        migrar_datos_lista,
+    ),
+    # 3: filtros por fecha en el historico de listas
+    (
+        "CREATE INDEX IF NOT EXISTS idx_Listas_FechaLista ON Listas (FechaLista);",
+    ),
+    # 4: hilo de estadisticas persistente que se edita en lugar de recrearse
+    (
+        "CREATE TABLE IF NOT EXISTS Configuracion (Clave TEXT PRIMARY KEY, Valor TEXT);",
+        "CREATE TABLE IF NOT EXISTS MensajesStats (Pagina INTEGER PRIMARY KEY, MensajeID INTEGER NOT NULL, Firma TEXT NOT NULL);",
+    ),
+    # 5: version del formato de DatosLista; las filas antiguas (0) se reparan con MigrateLists
+    (
+        "ALTER TABLE Listas ADD COLUMN FormatoDatos INTEGER NOT NULL DEFAULT 0;",
+    ),
+    # 6: copia de las listas abiertas para recuperarlas si el bot se reinicia
+    (
+        """
+        CREATE TABLE IF NOT EXISTS SesionesAbiertas (
+            GuildID INTEGER NOT NULL,
+            CanalID INTEGER NOT NULL,
+            DatosSesion TEXT NOT NULL,
+            PRIMARY KEY (GuildID, CanalID)
+        ) WITHOUT ROWID;
+        """,
+    ),
+    # 7: historial de asistencia por jugador, mantenido al cerrar cada lista
+    (
+        """
+        CREATE TABLE IF NOT EXISTS HistorialJugadores (
+            IdDiscord INTEGER PRIMARY KEY,
+            Listas INTEGER NOT NULL,
+            Asistencias INTEGER NOT NULL,
+            Ventana TEXT NOT NULL,
+            RachaAsistencias INTEGER NOT NULL,
+            RachaAusencias INTEGER NOT NULL,
+            UltimaLista INTEGER NOT NULL,
+            UltimaAsistencia TEXT
+        ) WITHOUT ROWID;
+        """,
+        reconstruir_historial,
+    ),
+]
+
+async def inicializar_db():
+    def migrar(con):
+        version = con.execute("PRAGMA user_version;").fetchone()[0]
+        for numero, sentencias in enumerate(MIGRACIONES[version:], version + 1):
+            for sentencia in sentencias:
+                if callable(sentencia):
+                    sentencia(con)
+                else:
+                    con.execute(sentencia)
+            con.execute(f"PRAGMA user_version = {numero};")
+            log.info("Migración %s aplicada a la base de datos.", numero)
+
+    await sql_transaccion(migrar, "migraciones")
+
+#################################################################################################
+
+class IndicePresencia:
+    """
+    Indice de miembros conectados a voz: guild -> {id de miembro: id del canal de voz}.
+
+    Se siembra una vez al arrancar recorriendo los canales de voz y despues se mantiene solo
+    con on_voice_state_update, asi saber si alguien esta conectado no obliga a recorrer canales.
+    """
+
+    def __init__(self):
+        self.canales = {}
+
+    def sembrar(self, guild):
+        self.canales[guild.id] = {member.id: channel.id for channel in guild.voice_channels for member in channel.members}
+
+    def actualizar(self, member, after):
+        canales_guild = self.canales.setdefault(member.guild.id, {})
+        if after.channel is None:
+            canales_guild.pop(member.id, None)
+        else:
+            canales_guild[member.id] = after.channel.id
+
+    def canal_de(self, guild_id, member_id):
+        return self.canales.get(guild_id, {}).get(member_id)
+
+    def conectado(self, guild_id, member_id):
+        return member_id in self.canales.get(guild_id, {})
+
+    def en_canal(self, guild_id, member_id, canal_id):
+        return self.canal_de(guild_id, member_id) == canal_id
+
+    def miembros_por_nombre(self, guild):
+        """Devuelve {display_name: member} de los conectados a voz en el guild."""
+        miembros = (guild.get_member(member_id) for member_id in self.canales.get(guild.id, {}))
+        return {member.display_name: member for member in miembros if member is not None}
+
+presencia = IndicePresencia()
+
+def normalizar_nombre(nombre):
+    """Nombre sin acentos, sin mayusculas y sin espacios en los extremos, para compararlo con lo escrito."""
+    descompuesto = unicodedata.normalize("NFKD", nombre.strip())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).casefold()
+
+def trigramas(normalizado):
+    """Trigramas de un nombre normalizado, con relleno para que los nombres cortos tambien tengan."""
+    relleno = f"  {normalizado} "
+    return {relleno[i:i + 3] for i in range(len(relleno) - 2)}
+
+class IndiceNombres:
+    """
+    Indice nombre -> miembro de quienes tienen el rol ROL_JUGADORES.
+
+    Se construye una vez con los miembros del rol y se mantiene con on_member_update,
+    on_user_update y on_member_remove, asi resolver un nombre escrito es una busqueda en un dict.
+    Se indexan el display_name y el nombre de usuario; si dos miembros comparten nombre gana el primero.
+
+    Para los nombres mal escritos hay ademas un indice aproximado: los nombres normalizados (sin
+    mayusculas ni acentos) -> miembros, y cada trigrama -> nombres normalizados que lo contienen.
+    Ambos se actualizan en añadir() y eliminar(), asi que siguen los mismos eventos.
+
+    Con `capacidad` (modo ligero) funciona como cache: guarda solo a los miembros usados mas
+    recientemente y recuerda durante un rato los nombres que Discord no ha encontrado.
+    """
+
+    DURACION_DESCARTE = 300  # Segundos durante los que no se vuelve a buscar un nombre no encontrado
+    LONGITUD_MINIMA = 4  # Los nombres mas cortos solo se reconocen exactos: casi cualquiera se les parece
+    PARECIDO_MINIMO = 0.5  # Coeficiente de Dice entre trigramas a partir del cual un nombre es candidato
+    PARECIDO_MINIMO_CORTO = 0.65  # El mismo umbral para nombres de menos de LONGITUD_LARGA caracteres
+    LONGITUD_LARGA = 8
+    MARGEN = 0.15  # Ventaja sobre el segundo candidato para dar por buena la coincidencia aproximada
+
+    def __init__(self, rol_id, capacidad=None):
+        self.rol_id = rol_id
+        self.capacidad = capacidad
+        self.por_nombre = {}  # nombre -> member
+        self.nombres = OrderedDict()  # id del miembro -> nombres con los que esta indexado, del menos al mas usado
+        self.descartados = OrderedDict()  # nombre -> momento en que no se encontro
+        self.miembros = {}  # id del miembro -> member
+        self.por_normalizado = {}  # nombre normalizado -> {id del miembro}
+        self.trigramas = {}  # trigrama -> {nombre normalizado}
+        self.num_trigramas = {}  # nombre normalizado -> cuantos trigramas distintos tiene
+
+    def __contains__(self, member_id):
+        return member_id in self.nombres
+
+    def reconstruir(self, guild):
+        role = guild.get_role(self.rol_id)
+        if role is None:
+            return
+        self.por_nombre.clear()
+        self.nombres.clear()
+        self.miembros.clear()
+        self.por_normalizado.clear()
+        self.trigramas.clear()
+        self.num_trigramas.clear()
+        for member in role.members:
+            self.añadir(member)
+
+    def añadir(self, member):
+        self.eliminar(member)
+        nombres = {member.display_name, member.name}
+        for nombre in nombres:
+            self.por_nombre.setdefault(nombre, member)
+        self.nombres[member.id] = nombres
+        self.miembros[member.id] = member
+        for normalizado in {normalizar_nombre(nombre) for nombre in nombres}:
+            ids = self.por_normalizado.setdefault(normalizado, set())
+            if not ids:
+                propios = trigramas(normalizado)
+                self.num_trigramas[normalizado] = len(propios)
+                for trigrama in propios:
+                    self.trigramas.setdefault(trigrama, set()).add(normalizado)
+            ids.add(member.id)
+        if self.capacidad and len(self.nombres) > self.capacidad:
+            self._eliminar_id(next(iter(self.nombres)))
+
+    def eliminar(self, member):
+        self._eliminar_id(member.id)
+
+    def _eliminar_id(self, member_id):
+        nombres = self.nombres.pop(member_id, ())
+        self.miembros.pop(member_id, None)
+        for nombre in nombres:
+            if self.por_nombre.get(nombre) is not None and self.por_nombre[nombre].id == member_id:
+                del self.por_nombre[nombre]
+        for normalizado in {normalizar_nombre(nombre) for nombre in nombres}:
+            ids = self.por_normalizado.get(normalizado)
+            if ids is None:
+                continue
+            ids.discard(member_id)
+            if not ids:
+                del self.por_normalizado[normalizado]
+                del self.num_trigramas[normalizado]
+                for trigrama in trigramas(normalizado):
+                    contienen = self.trigramas.get(trigrama)
+                    if contienen is not None:
+                        contienen.discard(normalizado)
+                        if not contienen:
+                            del self.trigramas[trigrama]
+
+    def actualizar(self, member):
+        if member.get_role(self.rol_id) is not None:
+            self.añadir(member)
+        else:
+            self.eliminar(member)
+
+    def resolver(self, nombre):
+        member = self.por_nombre.get(nombre)
+        if member is not None and self.capacidad:
+            self.nombres.move_to_end(member.id)
+        return member
+
+    def buscar(self, nombre):
+        """
+        Busca un nombre escrito tolerando mayusculas, acentos y erratas. Devuelve (member, candidatos):
+        el miembro si coincide salvo mayusculas y acentos, o None y los miembros a los que se parece
+        (vacio si no hay ninguno). Un solo candidato es una coincidencia aproximada clara, que aun
+        asi no se da por buena sin confirmarla.
+        """
+        member = self.resolver(nombre)
+        if member is not None:
+            return member, []
+        normalizado = normalizar_nombre(nombre)
+        ids = self.por_normalizado.get(normalizado)
+        if ids:
+            if len(ids) == 1:
+                return self._usar(next(iter(ids))), []
+            return None, [self.miembros[member_id] for member_id in ids]
+
+        if len(normalizado) < self.LONGITUD_MINIMA:
+            return None, []
+        minimo = self.PARECIDO_MINIMO if len(normalizado) >= self.LONGITUD_LARGA else self.PARECIDO_MINIMO_CORTO
+
+        # Coincidencia aproximada: cuantos trigramas comparte con cada nombre indexado
+        buscados = trigramas(normalizado)
+        comunes = {}
+        for trigrama in buscados:
+            for candidato in self.trigramas.get(trigrama, ()):
+                comunes[candidato] = comunes.get(candidato, 0) + 1
+        # Cada miembro puntua por el mas parecido de sus nombres
+        puntuados = {}
+        for candidato, n in comunes.items():
+            parecido = 2 * n / (len(buscados) + self.num_trigramas[candidato])
+            if parecido >= minimo:
+                for member_id in self.por_normalizado[candidato]:
+                    puntuados[member_id] = max(parecido, puntuados.get(member_id, 0))
+        if not puntuados:
+            return None, []
+        orden = sorted(puntuados, key=puntuados.get, reverse=True)
+        mejor = puntuados[orden[0]]
+        if len(orden) == 1 or puntuados[orden[1]] <= mejor - self.MARGEN:
+            return None, [self._usar(orden[0])]
+        return None, [self.miembros[member_id] for member_id in orden[:5] if puntuados[member_id] > mejor - self.MARGEN]
+
+    def obtener(self, member_id):
+        """El member guardado con ese id, o None."""
+        return self._usar(member_id) if member_id in self.miembros else None
+
+    def _usar(self, member_id):
+        if self.capacidad:
+            self.nombres.move_to_end(member_id)
+        return self.miembros[member_id]
+
+    def descartar(self, nombre):
+        self.descartados[nombre] = time.monotonic()
+        if len(self.descartados) > (self.capacidad or 0):
+            self.descartados.popitem(last=False)
+
+    def descartado(self, nombre):
+        momento = self.descartados.get(nombre)
+        if momento is None:
+            return False
+        if time.monotonic() - momento > self.DURACION_DESCARTE:
+            del self.descartados[nombre]
+            return False
+        return True
+
+class IndicesNombres:
+    """Un IndiceNombres por guild: un nombre escrito en un servidor solo se busca entre sus miembros."""
+
+    def __init__(self, rol_id, capacidad=None):
+        self.rol_id = rol_id
+        self.capacidad = capacidad
+        self.indices = {}  # guild -> IndiceNombres
+
+    def de(self, guild_id):
+        indice = self.indices.get(guild_id)
+        if indice is None:
+            indice = self.indices[guild_id] = IndiceNombres(self.rol_id, self.capacidad)
+        return indice
+
+indices_nombres = IndicesNombres(ROL_ID_JUGADORES, capacidad=int(os.getenv("LEAN_CACHE_SIZE") or 2000) if MODO_LIGERO else None)
+
+async def buscar_miembro(guild, nombre):
+    """
+    En modo ligero, pide a Discord los miembros cuyo nombre empieza por `nombre` y guarda en el
+    indice a los que tienen el rol. Devuelve el que coincide exactamente, o None.
+    """
+    indice = indices_nombres.de(guild.id)
+    if indice.descartado(nombre):
+        return None
+    try:
+        candidatos = await guild.query_members(query=nombre, limit=10, cache=False)
+    except asyncio.TimeoutError:
+        log.warning("Discord no ha respondido a la búsqueda del miembro %s", nombre)
+        return None
+    for member in candidatos:
+        indice.actualizar(member)
+    member = indice.resolver(nombre)
+    if member is None:
+        indice.descartar(nombre)
+    return member
+
+async def miembros_por_id(guild, ids):
+    """
+    Members de `ids` que siguen en el servidor. Se buscan en la cache de discord.py y en el indice de
+    nombres, y los que faltan se piden a Discord sin ampliar la cache: los que tienen el rol se
+    guardan en el indice, que en modo ligero tiene tamaño maximo.
+    """
+    indice = indices_nombres.de(guild.id)
+    miembros = {}
+    faltan = []
+    for member_id in ids:
+        member = guild.get_member(member_id) or indice.obtener(member_id)
+        if member is not None:
+            miembros[member_id] = member
+        else:
+            faltan.append(member_id)
+    for inicio in range(0, len(faltan), 100):  # query_members admite como mucho 100 ids por peticion
+        try:
+            for member in await guild.query_members(user_ids=faltan[inicio:inicio + 100], cache=False):
+                indice.actualizar(member)
+                miembros[member.id] = member
+        except (asyncio.TimeoutError, discord.ClientException) as error:
+            log.warning("No se pudieron pedir %s miembros del servidor %s: %s", len(faltan[inicio:inicio + 100]), guild.id, error)
+    return miembros
+
+def es_jugador(member):
+    """Si el miembro tiene el rol de jugadores. Se mira en el propio miembro, que siempre esta al dia."""
+    return member is not None and member.get_role(ROL_ID_JUGADORES) is not None
+
+#################################################################################################
+
+LINEA_CONECTADO = "🟢 Conectado"
+LINEA_DESCONECTADO = "🔴 Desconectado"
+
+class Roster:
+    """
+    Jugadores de una lista en orden con su estado de conexion (True si esta conectado).
+
+    Lleva la cuenta de conectados al dia con cada cambio y guarda ya unidas las columnas de los
+    embeds (numeros, nombres y estados) de la lista principal y de reservas. Un cambio solo invalida
+    la columna y la seccion que toca, asi pintar la lista tras un evento de voz no recorre a todos.
+    """
+
+    __slots__ = ("claves", "posiciones", "estados", "conectados", "nombrar", "corte", "columnas")
+
+    def __init__(self, jugadores=(), nombrar=str):
+        self.claves = []
+        self.posiciones = {}  # clave -> posicion en la lista, desde 0
+        self.estados = {}  # clave -> conectado
+        self.conectados = 0
+        self.nombrar = nombrar  # clave -> nombre con el que se muestra
+        self.corte = None  # max_jugadores con el que se unieron las columnas
+        self.columnas = ([None, None, None], [None, None, None])  # principal y reservas
+        for clave, estado in jugadores:
+            self.añadir(clave, estado == "si")
+
+    def __len__(self):
+        return len(self.claves)
+
+    def __contains__(self, clave):
+        return clave in self.estados
+
+    def __iter__(self):
+        return iter(self.claves)
+
+    @property
+    def desconectados(self):
+        return len(self.claves) - self.conectados
+
+    def conectado(self, clave):
+        return self.estados[clave]
+
+    def items(self):
+        """Pares (clave, 'si'/'no') en orden, como se guardan en la base de datos y en el diario."""
+        return [(clave, "si" if self.estados[clave] else "no") for clave in self.claves]
+
+    def añadir(self, clave, conectado):
+        if clave in self.estados:
+            self.cambiar_estado(clave, conectado)
+            return
+        self.posiciones[clave] = len(self.claves)
+        self.claves.append(clave)
+        self.estados[clave] = conectado
+        self.conectados += conectado
+        self._invalidar(self.posiciones[clave])
+
+    def cambiar_estado(self, clave, conectado):
+        """Devuelve True si el estado ha cambiado."""
+        if self.estados[clave] == conectado:
+            return False
+        self.estados[clave] = conectado
+        self.conectados += 1 if conectado else -1
+        self._invalidar(self.posiciones[clave], columna=2)
+        return True
+
+    def quitar(self, clave):
+        posicion = self.posiciones.pop(clave)
+        self.conectados -= self.estados.pop(clave)
+        del self.claves[posicion]
+        self._reindexar(posicion)
+
+    def mover(self, clave, posicion):
+        anterior = self.posiciones[clave]
+        del self.claves[anterior]
+        self.claves.insert(posicion, clave)
+        self._reindexar(min(anterior, posicion))
+
+    def renombrar(self, clave):
+        """El nombre con el que se muestra el jugador ha cambiado."""
+        if clave in self.posiciones:
+            self._invalidar(self.posiciones[clave], columna=1)
+
+    def _reindexar(self, desde):
+        for posicion in range(desde, len(self.claves)):
+            self.posiciones[self.claves[posicion]] = posicion
+        self.corte = None  # Las posiciones se han desplazado: se vuelven a unir todas las columnas
+
+    def _invalidar(self, posicion, columna=None):
+        if self.corte is None:
+            return
+        seccion = self.columnas[posicion >= self.corte]
+        if columna is None:
+            seccion[:] = (None, None, None)
+        else:
+            seccion[columna] = None
+
+    def seccion(self, max_jugadores, reservas=False):
+        """Columnas [numeros, nombres, estados] de la lista principal o de reservas, o None si esta vacia."""
+        if max_jugadores != self.corte:
+            self.corte = max_jugadores
+            self.columnas = ([None, None, None], [None, None, None])
+        inicio, fin = (max_jugadores, len(self.claves)) if reservas else (0, min(max_jugadores, len(self.claves)))
+        if inicio >= fin:
+            return None
+        columnas = self.columnas[reservas]
+        if columnas[0] is None:
+            columnas[0] = "\n".join(map(str, range(inicio + 1, fin + 1)))
+        if columnas[1] is None:
+            columnas[1] = "\n".join(self.nombrar(clave) for clave in self.claves[inicio:fin])
+        if columnas[2] is None:
+            columnas[2] = "\n".join(LINEA_CONECTADO if self.estados[clave] else LINEA_DESCONECTADO for clave in self.claves[inicio:fin])
+        return columnas
+
+class EventSession:
+    """
+    Estado de una lista abierta en un canal: jugadores, embeds, tarea de cierre y bloqueos.
+
+    Puede haber varias a la vez, una por (guild, canal). Las claves de la lista son el id del
+    miembro cuando se ha reconocido y el nombre escrito cuando no.
+    """
+
+    __slots__ = ("guild_id", "channel_id", "miembros_lista", "miembros_objetos", "nombres_guardados", "embed_main_message",
+                 "embed_reservas_message", "firmas_embeds", "lista_cerrada", "tarea_cerrar_lista",
+                 "tiempo_inicio_lista", "max_jugadores", "max_time", "actualizador", "adding_players",
+                 "adding_lock")
+
+    def __init__(self, guild_id, channel_id):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.lista_cerrada = True
+        self.tarea_cerrar_lista = None
+        self.adding_players = set()
+        self.adding_lock = asyncio.Lock()
+        self.reiniciar()
+
+    def reiniciar(self):
+        # El actualizador de la lista anterior se cancelo al cerrarla y ya no acepta peticiones
+        self.actualizador = ActualizadorEmbeds(self)
+        self.miembros_lista = Roster(nombrar=self.nombre_en_lista)
+        self.miembros_objetos = {}
+        self.nombres_guardados = {}  # id -> nombre guardado en la instantanea, para quien aun no tiene member
+        self.embed_main_message = None
+        self.embed_reservas_message = None
+        self.firmas_embeds = {}  # id del mensaje -> firma del ultimo contenido enviado
+        self.tiempo_inicio_lista = None
+        # Cada lista conserva los limites con los que se abrio aunque luego cambie la configuracion
+        self.max_jugadores = MAX_JUGADORES
+        self.max_time = MAX_TIME_LIST
+
+    @property
+    def clave(self):
+        return (self.guild_id, self.channel_id)
+
+    @property
+    def channel(self):
+        return bot.get_channel(self.channel_id)
+
+    @property
+    def admite_cambios(self):
+        """Si la lista esta abierta y no se ha empezado a cerrar."""
+        return not self.lista_cerrada and self.tarea_cerrar_lista is None
+
+    def añadir(self, clave, conectado, member=None, nombre=None):
+        self.miembros_lista.añadir(clave, conectado)
+        if member is not None:
+            self.miembros_objetos[clave] = member
+        elif nombre is not None:
+            self.nombres_guardados[clave] = nombre
+        if isinstance(clave, int):
+            # Se indexa aunque no haya member, para que sus eventos de voz lleguen a esta lista
+            sesiones.indexar(self, clave)
+        diario_sesiones.marcar(self)
+
+    def enlazar(self, member):
+        """Guarda el member de un jugador de la lista que se añadió solo con su id."""
+        if member.id in self.miembros_lista and member.id not in self.miembros_objetos:
+            self.miembros_objetos[member.id] = member
+            self.nombres_guardados.pop(member.id, None)
+            self.miembros_lista.renombrar(member.id)
+
+    def cambiar_estado(self, clave, conectado):
+        """Devuelve True si el estado ha cambiado."""
+        if not self.miembros_lista.cambiar_estado(clave, conectado):
+            return False
+        diario_sesiones.marcar(self)
+        return True
+
+    def quitar(self, clave):
+        self.miembros_lista.quitar(clave)
+        self.miembros_objetos.pop(clave, None)
+        self.nombres_guardados.pop(clave, None)
+        if isinstance(clave, int):
+            sesiones.desindexar(self, clave)
+            despachador_mensajes.cancelar(self, clave, "se ha quitado de la lista")
+        diario_sesiones.marcar(self)
+
+    def mover(self, clave, posicion):
+        """Mueve al jugador a `posicion`, desde 0; puede pasar de reservas a la lista principal y al reves."""
+        self.miembros_lista.mover(clave, posicion)
+        diario_sesiones.marcar(self)
+
+    def clave_de_nombre(self, nombre):
+        """Clave del jugador que se muestra como `nombre`, sin tener en cuenta mayusculas ni acentos, o None."""
+        buscado = normalizar_nombre(nombre)
+        for clave in self.miembros_lista:
+            if normalizar_nombre(self.nombre_en_lista(clave)) == buscado:
+                return clave
+        return None
+
+    def instantanea(self):
+        """Estado de la lista en JSON para guardarlo en SesionesAbiertas."""
+        return json.dumps({
+            "jugadores": [[clave, estado, self.nombre_en_lista(clave)] for clave, estado in self.miembros_lista.items()],
+            "embed": self.embed_main_message.id if self.embed_main_message else None,
+            "embed_reservas": self.embed_reservas_message.id if self.embed_reservas_message else None,
+            "inicio": self.tiempo_inicio_lista,
+            "max_jugadores": self.max_jugadores,
+            "max_time": self.max_time,
+        }, ensure_ascii=False)
+
+    def nombre_en_lista(self, clave):
+        """
+        Nombre con el que se muestra un jugador de la lista: el display_name actual si se tiene el
+        member y si no el nombre guardado al restaurar la lista o el texto escrito.
+        """
+        member = self.miembros_objetos.get(clave)
+        if member is not None:
+            return member.display_name
+        return self.nombres_guardados.get(clave, str(clave))
+
+class RegistroSesiones:
+    """
+    Sesiones por (guild, canal) y un indice (guild, miembro) -> sesiones en cuya lista aparece.
+
+    Con el indice, un evento de voz solo toca las listas del miembro afectado, sin recorrer
+    todas las sesiones abiertas.
+    """
+
+    def __init__(self):
+        self.sesiones = {}  # (guild, canal) -> EventSession
+        self.por_miembro = {}  # (guild, id del miembro) -> {EventSession}
+        self.abiertas_guild = {}  # guild -> {EventSession} con la lista abierta
+
+    def obtener(self, guild_id, channel_id):
+        sesion = self.sesiones.get((guild_id, channel_id))
+        if sesion is None:
+            sesion = self.sesiones[(guild_id, channel_id)] = EventSession(guild_id, channel_id)
+        return sesion
+
+    def de_contexto(self, ctx):
+        return self.sesiones.get((ctx.guild.id, ctx.channel.id)) if ctx.guild else None
+
+    def abrir(self, sesion):
+        sesion.reiniciar()
+        despachador_mensajes.olvidar(sesion.clave)
+        sesion.lista_cerrada = False
+        sesion.tiempo_inicio_lista = time.time()
+        self.abiertas_guild.setdefault(sesion.guild_id, set()).add(sesion)
+        diario_sesiones.marcar(sesion)
+
+    def cerrar(self, sesion):
+        sesion.lista_cerrada = True
+        planificador.cancelar(sesion)
+        diario_sesiones.marcar(sesion)
+        self.retirar(sesion)
+
+    def retirar(self, sesion):
+        """Deja de enviar a la sesion los eventos de voz y los cambios de nombre; la lista se esta cerrando."""
+        self.abiertas_guild.get(sesion.guild_id, set()).discard(sesion)
+        for member_id in sesion.miembros_lista:
+            if isinstance(member_id, int):
+                self.desindexar(sesion, member_id)
+
+    def desindexar(self, sesion, member_id):
+        clave = (sesion.guild_id, member_id)
+        afectadas = self.por_miembro.get(clave)
+        if afectadas is not None:
+            afectadas.discard(sesion)
+            if not afectadas:
+                del self.por_miembro[clave]
+
+    def indexar(self, sesion, member_id):
+        if not sesion.admite_cambios:
+            return
+        self.por_miembro.setdefault((sesion.guild_id, member_id), set()).add(sesion)
+
+    def de_miembro(self, guild_id, member_id):
+        return self.por_miembro.get((guild_id, member_id), ())
+
+    def abiertas(self, guild_id=None):
+        if guild_id is not None:
+            return list(self.abiertas_guild.get(guild_id, ()))
+        return [sesion for abiertas in self.abiertas_guild.values() for sesion in abiertas]
+
+sesiones = RegistroSesiones()
+
+class DiarioSesiones:
+    """
+    Copia en SQLite de las listas abiertas, escrita en diferido.
+
+    marcar() solo apunta la sesion como modificada; una tarea vuelca todas las pendientes en una
+    unica transaccion como mucho una vez por intervalo, asi una rafaga de cambios cuesta un commit.
+    Las sesiones cerradas se borran de la tabla en el mismo volcado.
+    """
+
+    def __init__(self, intervalo=1):
+        self.intervalo = intervalo
+        self.sucias = {}  # (guild, canal) -> EventSession
+        self.pendiente = asyncio.Event()
+        self.tarea = None
+
+    def marcar(self, sesion):
+        self.sucias[sesion.clave] = sesion
+        self.pendiente.set()
+        if self.tarea is None or self.tarea.done():
+            self.tarea = asyncio.create_task(self._bucle())
+
+    async def _bucle(self):
+        while True:
+            await self.pendiente.wait()
+            self.pendiente.clear()
+            await self.volcar()
+            await asyncio.sleep(self.intervalo)
+
+    async def volcar(self):
+        if not self.sucias:
+            return
+        sucias, self.sucias = self.sucias, {}
+        # La instantanea se toma aqui, en el bucle de eventos; el hilo de la base de datos solo escribe
+        guardar = [clave + (sesion.instantanea(),) for clave, sesion in sucias.items() if not sesion.lista_cerrada]
+        borrar = [clave for clave, sesion in sucias.items() if sesion.lista_cerrada]
+
+        def escribir(con):
+            con.executemany("""
+                INSERT INTO SesionesAbiertas (GuildID, CanalID, DatosSesion) VALUES (?, ?, ?)
+                ON CONFLICT (GuildID, CanalID) DO UPDATE SET DatosSesion = excluded.DatosSesion;
+            """, guardar)
+            con.executemany("DELETE FROM SesionesAbiertas WHERE GuildID = ? AND CanalID = ?;", borrar)
+
+        await sql_transaccion(escribir, "diario de sesiones")
+
+diario_sesiones = DiarioSesiones()
+
+class PlanificadorSesiones:
+    """
+    Todas las acciones con hora de las listas abiertas en un unico monticulo atendido por una sola tarea:
+    el cierre automatico, el refresco de la cuenta atras y los recordatorios por privado.
+
+    Programar o sacar una accion cuesta O(log n) sin importar cuantas listas haya. Para anular las
+    acciones de una sesion (al cerrarla, cancelarla o ampliar su tiempo) no se buscan en el monticulo:
+    se sube su generacion y las entradas antiguas se descartan al salir.
+    """
+
+    def __init__(self):
+        self.monticulo = []  # (momento, secuencia, generacion, sesion, accion, dato)
+        self.generaciones = {}  # (guild, canal) -> generacion vigente de la sesion
+        self.secuencia = itertools.count()  # desempata entradas con el mismo momento sin comparar sesiones
+        self.despertar = asyncio.Event()
+        self.tarea = None
+
+    def programar(self, sesion):
+        """(Re)programa las acciones de la sesion a partir de su inicio y su max_time; anula las anteriores."""
+        self.cancelar(sesion)
+        generacion = self.generaciones[sesion.clave] = next(self.secuencia)
+        fin = sesion.tiempo_inicio_lista + sesion.max_time
+        ahora = time.time()
+        self._añadir(fin, generacion, sesion, "cierre")
+        if send_messages:
+            for antes in RECORDATORIOS:
+                if fin - antes > ahora:
+                    self._añadir(fin - antes, generacion, sesion, "recordatorio", antes)
+        self._siguiente_cuenta_atras(sesion, generacion, ahora)
+        if self.tarea is None or self.tarea.done():
+            self.tarea = asyncio.create_task(self._bucle())
+
+    def cancelar(self, sesion):
+        self.generaciones.pop(sesion.clave, None)
+
+    def restante(self, sesion):
+        return max(0, sesion.tiempo_inicio_lista + sesion.max_time - time.time())
+
+    def _añadir(self, momento, generacion, sesion, accion, dato=None):
+        heapq.heappush(self.monticulo, (momento, next(self.secuencia), generacion, sesion, accion, dato))
+        if self.monticulo[0][0] == momento:
+            self.despertar.set()  # La tarea duerme hasta una accion posterior: que recalcule la espera
+
+    def _siguiente_cuenta_atras(self, sesion, generacion, ahora):
+        # Los refrescos caen en minutos exactos antes del cierre para que la cuenta atras quede redonda
+        if not INTERVALO_CUENTA_ATRAS:
+            return
+        fin = sesion.tiempo_inicio_lista + sesion.max_time
+        momento = fin - (fin - ahora) // INTERVALO_CUENTA_ATRAS * INTERVALO_CUENTA_ATRAS
+        if momento <= ahora:
+            momento += INTERVALO_CUENTA_ATRAS
+        if momento < fin:
+            self._añadir(momento, generacion, sesion, "cuenta_atras")
+
+    def _vigente(self, entrada):
+        _, _, generacion, sesion, _, _ = entrada
+        return self.generaciones.get(sesion.clave) == generacion
+
+    async def _bucle(self):
+        while True:
+            while self.monticulo and not self._vigente(self.monticulo[0]):
+                heapq.heappop(self.monticulo)
+            self.despertar.clear()
+            if not self.monticulo:
+                await self.despertar.wait()
+                continue
+            espera = self.monticulo[0][0] - time.time()
+            if espera > 0:
+                try:
+                    await asyncio.wait_for(self.despertar.wait(), espera)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            momento, _, generacion, sesion, accion, dato = heapq.heappop(self.monticulo)
+            metricas.observar("retraso_planificador_segundos", time.time() - momento, accion=accion)
+            try:
+                self._ejecutar(sesion, generacion, accion, dato)
+            except Exception:
+                log.exception("Error al ejecutar la acción programada %s", accion, extra={"sesion": sesion.clave})
+
+    def _ejecutar(self, sesion, generacion, accion, dato):
+        if accion == "cierre":
+            asyncio.create_task(cerrar_lista(sesion))
+        elif accion == "cuenta_atras":
+            sesion.actualizador.solicitar(cuenta_atras=True)
+            self._siguiente_cuenta_atras(sesion, generacion, time.time())
+        elif accion == "recordatorio":
+            guild = bot.get_guild(sesion.guild_id)
+            if guild is not None:
+                log.info("Recordatorio a los desconectados, %s segundos antes del cierre", dato, extra={"sesion": sesion.clave})
+                encolar_mensajes_privados(sesion, guild, restante=dato)
+
+planificador = PlanificadorSesiones()
 
 #################################################################################################
 
 @bot.event
 async def on_ready():
-    print('We have logged in as {0.user}'.format(bot))
-    # Iniciar el check periódico para actualizar miembros conectados
-    bot.loop.create_task(comprobar_conectados_periodicamente())
-    bot.loop.create_task(borrar_mensajes_sin_embed())
+    global bot_inicializado
+
+    log.info("We have logged in as %s", bot.user)
+    # on_ready se repite en cada reconexion completa: lo siguiente solo debe hacerse una vez
+    if bot_inicializado:
+        if not MODO_SHARDS:  # Con shards se resincroniza cada uno en on_shard_ready
+            resincronizador_presencia.solicitar()
+        await restaurar_sesiones()  # Las que no se pudieron restaurar la vez anterior
+        return
+    bot_inicializado = True
+
+    for guild in bot.guilds:
+        presencia.sembrar(guild)
+        indices_nombres.de(guild.id).reconstruir(guild)
+    await inicializar_db()
+    await restaurar_sesiones()
+    await sincronizar_comandos()
+    await iniciar_metricas()
+    vigilante_bucle.iniciar()
+    for channel_id in CANALES_EVENTOS:
+        bot.loop.create_task(borrar_mensajes_sin_embed(channel_id))
+
+async def restaurar_sesiones():
+    """
+    Recupera las listas que estaban abiertas cuando el bot se detuvo: vuelve a enlazar sus
+    embeds, corrige los estados con la voz actual y programa el cierre para el tiempo que quedaba.
+
+    Si el guild o el canal aun no estan disponibles la lista se deja guardada y se vuelve a
+    intentar en el siguiente on_ready; solo se borra si Discord confirma que el canal ya no existe.
+    """
+    for guild_id, channel_id, datos_sesion in await sql_fetch("SELECT GuildID, CanalID, DatosSesion FROM SesionesAbiertas;"):
+        sesion = sesiones.obtener(guild_id, channel_id)
+        if not sesion.lista_cerrada:  # Ya restaurada en un on_ready anterior
+            continue
+        guild = bot.get_guild(guild_id)
+        channel = bot.get_channel(channel_id)
+        if guild is None or guild.unavailable or channel is None:
+            if await canal_borrado(channel_id):
+                log.warning("No se puede restaurar la lista del canal %s: el canal ya no existe.", channel_id, extra={"sesion": sesion.clave})
+                diario_sesiones.marcar(sesion)  # Sigue cerrada, asi que se borra de la tabla
+            else:
+                log.warning("La lista del canal %s no se puede restaurar todavía; se reintentará en la próxima conexión.", channel_id, extra={"sesion": sesion.clave})
+            continue
+
+        datos = json.loads(datos_sesion)
+        sesiones.abrir(sesion)
+        sesion.tiempo_inicio_lista = datos["inicio"]
+        sesion.max_jugadores = datos["max_jugadores"]
+        sesion.max_time = datos["max_time"]
+        # Con la cache de miembros reducida o si alguien ha salido del servidor get_member no lo encuentra
+        jugadores = datos["jugadores"]
+        miembros = await miembros_por_id(guild, [j[0] for j in jugadores if isinstance(j[0], int)])
+        for clave, estado, *nombre in jugadores:  # Las instantaneas antiguas no guardaban el nombre
+            sesion.añadir(clave, estado == "si", miembros.get(clave), nombre[0] if nombre else None)
+
+        # Si un embed se borró mientras el bot estaba parado se volverá a enviar
+        for atributo, clave in (("embed_main_message", "embed"), ("embed_reservas_message", "embed_reservas")):
+            if datos[clave]:
+                try:
+                    setattr(sesion, atributo, await channel.fetch_message(datos[clave]))
+                except discord.HTTPException:
+                    log.warning("No se encontró el embed %s de la lista del canal %s.", datos[clave], channel_id, extra={"sesion": sesion.clave})
+
+        reconciliar_sesion(sesion, guild)
+        planificador.programar(sesion)  # Si ya ha pasado la hora se cierra enseguida
+        sesion.actualizador.solicitar()
+        log.info("Lista del canal %s restaurada con %s jugadores; se cerrará en %ss.", channel_id, len(sesion.miembros_lista), int(planificador.restante(sesion)), extra={"sesion": sesion.clave})
+
+async def canal_borrado(channel_id):
+    """True solo si Discord confirma que el canal no existe; con cualquier otro error no se sabe."""
+    try:
+        await bot.fetch_channel(channel_id)
+    except discord.NotFound:
+        return True
+    except discord.HTTPException as error:
+        log.debug("No se pudo comprobar el canal %s: %s", channel_id, error)
+    return False
+
+@bot.event
+async def on_resumed():
+    # Los eventos perdidos durante el corte se reenvian al reanudar, pero se comprueba por si acaso
+    if not MODO_SHARDS:  # Con shards discord.py tambien avisa con on_shard_resumed, que dice cual
+        resincronizador_presencia.solicitar()
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    resincronizador_presencia.solicitar(shard_id)
+
+@bot.event
+async def on_shard_ready(shard_id):
+    # Un shard que vuelve a identificarse tras la puesta en marcha ha podido perder eventos de voz
+    if bot_inicializado:
+        resincronizador_presencia.solicitar(shard_id)
+
+@bot.event
+@medir_evento
+async def on_member_update(before, after):
+    indices_nombres.de(after.guild.id).actualizar(after)
+    if before.display_name != after.display_name:
+        renombrar_en_listas(after)
+
+@bot.event
+@medir_evento
+async def on_user_update(before, after):
+    # Un cambio de global_name o de usuario tambien cambia el display_name de quien no tiene apodo
+    for guild in after.mutual_guilds:
+        member = guild.get_member(after.id)
+        if member is not None:
+            indice = indices_nombres.de(guild.id)
+            if after.id in indice:
+                indice.actualizar(member)
+            renombrar_en_listas(member)
+
+def renombrar_en_listas(member):
+    """El nombre del miembro ha cambiado: vuelve a pintar las listas abiertas en las que aparece."""
+    for sesion in sesiones.de_miembro(member.guild.id, member.id):
+        sesion.enlazar(member)
+        sesion.miembros_lista.renombrar(member.id)
+        sesion.actualizador.solicitar()
+
+@bot.event
+@medir_evento
+async def on_member_remove(member):
+    indices_nombres.de(member.guild.id).eliminar(member)
 
 #################################################################################################
 
 @bot.event
+@medir_evento
 async def on_message(message):
     global ROL_ID_ADMINS
 
-    if message.author == bot.user:
+    # Verificar si el mensaje no es de uno de los canales de eventos
+    if message.channel.id not in limpiadores_canal:
         return
 
-    # Obtener el canal desde la configuración
-    channel = bot.get_channel(int(config['channel_default']))
-    
-    # Verificar si el mensaje no es del canal correcto
-    if message.channel != channel:
+    # Cualquier mensaje del canal, también los del bot, cuenta para la próxima limpieza
+    limpiadores_canal[message.channel.id].registrar(message)
+
+    if message.author == bot.user:
         return
 
     # Verificar si el autor tiene el rol necesario
     if ROL_ID_ADMINS not in [role.id for role in message.author.roles]:
-        print(f"{message.author.display_name} no tiene el rol necesario. Mensaje ignorado.")
+        log.debug("%s no tiene el rol necesario. Mensaje ignorado.", message.author.display_name, extra={"miembro": message.author.id})
         return  # No hacer nada si el autor no tiene el rol
 
     # Si el mensaje empieza con 'ping', responder 'Pong'
@@ -155,175 +1546,354 @@ async def on_message(message):
 
 #################################################################################################
 
-async def eliminar_jugadores_no_en_lista(channel_or_ctx):
-    global miembros_lista, miembros_objetos
+def resolver_jugador(nombre, connected_members, indice):
+    """
+    Resuelve un nombre escrito a (clave, member, candidatos). La clave es el id del miembro si se
+    reconoce entre los que tienen el rol, sin tener en cuenta mayusculas ni acentos, o entre los
+    conectados a voz; si no, el propio nombre. Si solo se parece a miembros del rol no se elige
+    ninguno y se devuelven.
+    """
+    member = indice.resolver(nombre) or connected_members.get(nombre)
+    candidatos = []
+    if member is None:
+        member, candidatos = indice.buscar(nombre)
+    if member is None:
+        return nombre, None, candidatos
+    return member.id, member, []
 
-    # Obtener el guild dependiendo del tipo de entrada
-    guild = channel_or_ctx.guild if hasattr(channel_or_ctx, 'guild') else channel_or_ctx
-    miembros_objetos = {member.display_name: member for member in guild.members if ROL_ID_JUGADORES in [role.id for role in member.roles]}
+#################################################################################################
 
-    jugadores_en_lista = set(miembros_lista.keys())
-    jugadores_a_eliminar = [jugador for jugador in miembros_objetos if jugador not in jugadores_en_lista]
+def es_admin_en_canal_eventos(interaction):
+    """Los comandos de barra solo los usan los admins y solo en los canales de eventos."""
+    return interaction.channel_id in limpiadores_canal and any(role.id == ROL_ID_ADMINS for role in getattr(interaction.user, "roles", ()))
 
-    for jugador in jugadores_a_eliminar:
-        del miembros_objetos[jugador]
+@bot.tree.error
+async def on_app_command_error(interaction, error):
+    if isinstance(error, app_commands.CheckFailure):
+        mensaje = "⛔ No tienes permiso para usar este comando aquí."
+    else:
+        log.error("Error en el comando /%s: %s", interaction.command.name if interaction.command else "?", error, exc_info=error, extra={"miembro": interaction.user.id})
+        mensaje = "⚠️ Ha ocurrido un error al ejecutar el comando."
+    if interaction.response.is_done():
+        await interaction.followup.send(mensaje, ephemeral=True)
+    else:
+        await interaction.response.send_message(mensaje, ephemeral=True)
 
-#################################################################################################
+async def sincronizar_comandos():
+    """
+    Registra los comandos de barra en Discord solo si han cambiado desde la ultima vez. La firma
+    de los comandos se guarda en Configuracion, asi un reinicio normal no hace ninguna llamada.
+    """
+    comandos = [comando.to_dict(bot.tree) for comando in bot.tree.get_commands()]
+    firma = hashlib.sha1(json.dumps(comandos, sort_keys=True).encode()).hexdigest()
+    if await leer_configuracion("FirmaComandos") == firma:
+        return
+    try:
+        await bot.tree.sync()
+    except discord.HTTPException as error:
+        log.error("Error al sincronizar los comandos de barra: %s", error)
+        return
+    await guardar_configuracion("FirmaComandos", firma)
+    log.info("%s comandos de barra sincronizados con Discord.", len(comandos))
 
-@bot.command()
-async def NewList(ctx):
-    global miembros_lista, miembros_objetos, embed_main_message, embed_reservas_message, lista_cerrada, tiempo_inicio_lista, tarea_cerrar_lista, send_messages
-
-    miembros_lista = {}
-    miembros_objetos = {}
-    embed_main_message = None
-    embed_reservas_message = None
-    lista_cerrada = False
-    tiempo_inicio_lista = time.time()
-    tarea_cerrar_lista = None  # Reiniciar tarea_cerrar_lista aquí
-    
-    await ctx.send("✍ Introduce los elementos de la lista. Escribe `FIN` para terminar.")
-    bot.loop.create_task(cerrar_lista(MAX_TIME_LIST))  # Esto asignará tarea_cerrar_lista
+class ModalJugadores(discord.ui.Modal):
+    """Formulario para escribir de una vez todos los jugadores, uno por linea."""
 
-    connected_members = {member.display_name: member for guild in bot.guilds for channel in guild.voice_channels for member in channel.members}
-    print(f"Miembros conectados en voz: {connected_members}")
+    jugadores = discord.ui.TextInput(label="Jugadores (uno por línea)", style=discord.TextStyle.paragraph, max_length=4000)
 
-    while True:
-        try:
-            msg = await bot.wait_for('message', check=lambda m: m.author == ctx.author, timeout=60)
-            if msg.content.strip().upper() == "FIN":
-                break
-            nuevos_miembros = set()
-            lista_temporal = {}
-            for miembro in msg.content.splitlines():
-                miembro = miembro.strip()
-                if miembro:
-                    if miembro in miembros_lista or miembro in nuevos_miembros:
-                        await ctx.send(f"⚠️ `{miembro}` ya está en la lista. Envía la lista nuevamente sin duplicados.")
-                        break
-                    nuevos_miembros.add(miembro)
-                    if miembro in connected_members:
-                        lista_temporal[miembro] = "si"
-                        miembros_objetos[miembro] = connected_members[miembro]
-                        print(f"Se ha añadido correctamente el jugador: {miembro}")
-                    else:
-                        lista_temporal[miembro] = "no"
+    def __init__(self, titulo, al_enviar):
+        super().__init__(title=titulo, timeout=600)
+        self.al_enviar = al_enviar
+
+    async def on_submit(self, interaction):
+        await self.al_enviar(interaction, self.jugadores.value)
+
+class VistaConfirmacion(discord.ui.View):
+    """Botones Confirmar/Cancelar que solo puede pulsar quien lanzo el comando."""
+
+    def __init__(self, autor_id, timeout=30):
+        super().__init__(timeout=timeout)
+        self.autor_id = autor_id
+        self.confirmado = False
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.autor_id
+
+    @discord.ui.button(label="Confirmar", style=discord.ButtonStyle.danger)
+    async def confirmar(self, interaction, button):
+        self.confirmado = True
+        await interaction.response.edit_message(view=None)
+        self.stop()
+
+    @discord.ui.button(label="Cancelar", style=discord.ButtonStyle.secondary)
+    async def cancelar(self, interaction, button):
+        await interaction.response.edit_message(view=None)
+        self.stop()
+
+async def confirmar(interaction, pregunta):
+    """Pregunta con botones y devuelve True si el autor confirma antes de que caduque."""
+    vista = VistaConfirmacion(interaction.user.id)
+    await interaction.response.send_message(pregunta, view=vista, ephemeral=True)
+    await vista.wait()
+    return vista.confirmado
+
+async def añadir_nombres(sesion, guild, texto):
+    """
+    Añade a la sesion los jugadores escritos en texto, uno por linea, con su estado de voz actual.
+    Devuelve (repetidos, corregidos, dudosos, sugeridos): los nombres que ya estaban en la lista, los
+    que se han reconocido con otras mayusculas o acentos, los que se parecen a varios miembros y los
+    que se parecen claramente a uno, como (nombre, member). Los dos ultimos no se añaden; los
+    sugeridos se ofrecen despues con confirmar_sugeridos().
+    """
+    connected_members = presencia.miembros_por_nombre(guild)
+    indice = indices_nombres.de(guild.id)
+    nombres = [nombre.strip() for nombre in texto.splitlines() if nombre.strip()]
+    if MODO_LIGERO:
+        # Los nombres que no estan en cache se buscan en Discord todos a la vez
+        desconocidos = {nombre for nombre in nombres if nombre not in connected_members and indice.resolver(nombre) is None}
+        await asyncio.gather(*(buscar_miembro(guild, nombre) for nombre in desconocidos))
+    repetidos, corregidos, dudosos, sugeridos = [], [], [], []
+    for nombre in nombres:
+        clave, member, candidatos = resolver_jugador(nombre, connected_members, indice)
+        if len(candidatos) == 1:
+            parecido = candidatos[0]
+            if parecido.id in sesion.miembros_lista or any(member.id == parecido.id for _, member in sugeridos):
+                repetidos.append(nombre)
             else:
-                miembros_lista.update(lista_temporal)
-                await msg.delete()
-                continue
-        except asyncio.TimeoutError:
-            await ctx.send("⏳ Tiempo de espera agotado. Operación cancelada.")
-            return
+                sugeridos.append((nombre, parecido))
+            continue
+        if candidatos:
+            dudosos.append((nombre, candidatos))
+            continue
+        if clave in sesion.miembros_lista:
+            repetidos.append(nombre)
+            continue
+        if member is not None and nombre not in (member.display_name, member.name):
+            corregidos.append((nombre, member.display_name))
+        if member is not None and presencia.conectado(guild.id, member.id):
+            sesion.añadir(clave, True, member)
+            log.info("Se ha añadido correctamente el jugador: %s", nombre, extra={"sesion": sesion.clave, "miembro": member.id})
+        else:
+            sesion.añadir(clave, False, member)
+    return repetidos, corregidos, dudosos, sugeridos
+
+async def confirmar_sugeridos(interaction, sesion, sugeridos):
+    """
+    Pregunta al admin si añade a los miembros que solo se han reconocido por parecido. Se llama
+    despues de responder a la interaccion, asi que la pregunta va como mensaje de seguimiento.
+    """
+    if not sugeridos:
+        return
+    vista = VistaConfirmacion(interaction.user.id, timeout=120)
+    lineas = "\n".join(f"`{nombre}` → {member.display_name}" for nombre, member in sugeridos)
+    await interaction.followup.send(f"🔎 Estos nombres no coinciden exactamente. ¿Añadir a estos jugadores?\n{lineas}"[:2000], view=vista, ephemeral=True)
+    await vista.wait()
+    if not vista.confirmado or not sesion.admite_cambios:
+        return
 
-    if not miembros_lista:
-        await ctx.send("⚠️ No has introducido ningún miembro. Por favor, vuelve a intentarlo con `/NewList`.")
+    guild = interaction.guild
+    for nombre, member in sugeridos:
+        if member.id in sesion.miembros_lista:
+            continue
+        conectado = presencia.conectado(guild.id, member.id)
+        sesion.añadir(member.id, conectado, member)
+        log.info("Se ha añadido el jugador %s escrito como %s", member.display_name, nombre, extra={"sesion": sesion.clave, "miembro": member.id})
+        if send_messages and not conectado and es_jugador(member):
+            despachador_mensajes.encolar(sesion, member, guild.name)
+    sesion.actualizador.solicitar()
+
+def texto_avisos(repetidos, corregidos, dudosos, sugeridos=()):
+    texto = ""
+    if corregidos:
+        texto += f"\n✏️ Nombres corregidos: {', '.join(f'`{escrito}` → {nombre}' for escrito, nombre in corregidos)}"
+    if repetidos:
+        texto += f"\n⚠️ Ya estaban en la lista y se han ignorado: {', '.join(f'`{nombre}`' for nombre in repetidos)}"
+    for nombre, candidatos in dudosos:
+        texto += f"\n❓ `{nombre}` no se ha añadido, puede ser: {', '.join(f'`{member.display_name}`' for member in candidatos)}. Añádelo con `/addplayers` y el nombre exacto."
+    if sugeridos:
+        texto += f"\n🔎 Pendientes de confirmar: {', '.join(f'`{nombre}`' for nombre, _ in sugeridos)}"
+    return texto if len(texto) <= 1900 else texto[:1897] + "..."  # Que el mensaje no pase del limite de Discord
+
+#################################################################################################
+
+@bot.tree.command(name="newlist", description="Crea una lista de jugadores en este canal")
+@app_commands.check(es_admin_en_canal_eventos)
+async def NewList(interaction: discord.Interaction):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is not None and not sesion.lista_cerrada:
+        await interaction.response.send_message("⚠️ Ya hay una lista abierta en este canal. Ciérrala o cancélala antes de crear otra.", ephemeral=True)
         return
+    await interaction.response.send_modal(ModalJugadores("Nueva lista", crear_lista))
+
+async def crear_lista(interaction, texto):
+    sesion = sesiones.obtener(interaction.guild_id, interaction.channel_id)
+    if not sesion.lista_cerrada:  # Otro admin la ha abierto mientras se rellenaba el formulario
+        await interaction.response.send_message("⚠️ Ya hay una lista abierta en este canal.", ephemeral=True)
+        return
+
+    sesiones.abrir(sesion)
+    # Buscar los nombres puede llevar mas de los 3 segundos que Discord da para responder
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    repetidos, corregidos, dudosos, sugeridos = await añadir_nombres(sesion, interaction.guild, texto)
+    if not sesion.miembros_lista:
+        sesiones.cerrar(sesion)
+        sesion.reiniciar()
+        # Sin lista no hay donde confirmar los parecidos: se muestran como dudas
+        dudosos += [(nombre, [member]) for nombre, member in sugeridos]
+        await interaction.followup.send(f"⚠️ No has introducido ningún miembro. Por favor, vuelve a intentarlo con `/newlist`.{texto_avisos(repetidos, corregidos, dudosos)}", ephemeral=True)
+        return
+
+    await interaction.followup.send(f"✅ Lista creada con {len(sesion.miembros_lista)} jugadores.{texto_avisos(repetidos, corregidos, dudosos, sugeridos)}", ephemeral=True)
+    planificador.programar(sesion)
 
-    await eliminar_jugadores_no_en_lista(ctx)
-    print(f"miembros_objetos con ROL: `{miembros_objetos}`")
-    await actualizar_embeds(ctx)
+    log.debug("Lista creada con %s jugadores identificados", len(sesion.miembros_objetos), extra={"sesion": sesion.clave})
+    # El primer envio de los embeds tambien pasa por el actualizador, para que no coincida con otra
+    # edicion pedida por un evento de voz y se envien dos embeds principales
+    sesion.actualizador.solicitar()
     if send_messages:
-        await enviar_mensajes_privados(ctx)
+        encolar_mensajes_privados(sesion, interaction.guild)
     else:
-        print("Los mensajes privados están desactivados.")
+        log.info("Los mensajes privados están desactivados.")
+    await confirmar_sugeridos(interaction, sesion, sugeridos)
 
 #################################################################################################
 
-async def actualizar_embeds(channel_or_ctx):
-    global embed_main_message, embed_reservas_message
+async def actualizar_embeds(sesion, cuenta_atras=False):
+    channel = sesion.channel
+    embed_main, embed_reservas = generar_embeds(sesion=sesion)
+    firmas_embeds = sesion.firmas_embeds
     
-    # Determinar el canal para enviar mensajes
-    if isinstance(channel_or_ctx, discord.TextChannel):
-        channel = channel_or_ctx
-    elif isinstance(channel_or_ctx, discord.Thread):
-        channel = channel_or_ctx.parent  # Obtener el canal padre del hilo
-    elif isinstance(channel_or_ctx, commands.Context):
-        channel = channel_or_ctx.channel  # Para contextos de comandos
-    elif isinstance(channel_or_ctx, discord.ForumChannel):
-        # Opcional: Si el canal es un foro, intentar usar un hilo predeterminado
-        # Aquí asumimos que quieres usar un hilo específico; ajusta según tu caso
-        threads = channel_or_ctx.threads
-        if threads:
-            channel = threads[0]  # Usar el primer hilo del foro (ajusta según tu lógica)
-        else:
-            print("Error: No se encontraron hilos en el ForumChannel.")
-            return
-    else:
-        print(f"Error: Tipo de canal no soportado: {type(channel_or_ctx)}")
-        channel = bot.get_channel(int(config['channel_default']))
-    
-    embed_main, embed_reservas = generar_embeds()
-    
-    if embed_main_message:
-        await embed_main_message.edit(embed=embed_main)
+    # Solo se edita un mensaje si su contenido ha cambiado desde la ultima vez, o si toca refrescar la cuenta atras
+    if sesion.embed_main_message:
+        firma = firma_embed(embed_main)
+        if cuenta_atras or firmas_embeds.get(sesion.embed_main_message.id) != firma:
+            await sesion.embed_main_message.edit(embed=embed_main)
+            metricas.contar("ediciones_total", tipo="embed")
+            firmas_embeds[sesion.embed_main_message.id] = firma
     else:
-        embed_main_message = await channel.send(embed=embed_main)
+        sesion.embed_main_message = await channel.send(embed=embed_main)
+        firmas_embeds[sesion.embed_main_message.id] = firma_embed(embed_main)
+        diario_sesiones.marcar(sesion)
     
     if embed_reservas:
-        if embed_reservas_message:
-            await embed_reservas_message.edit(embed=embed_reservas)
+        if sesion.embed_reservas_message:
+            firma = firma_embed(embed_reservas)
+            if firmas_embeds.get(sesion.embed_reservas_message.id) != firma:
+                await sesion.embed_reservas_message.edit(embed=embed_reservas)
+                metricas.contar("ediciones_total", tipo="embed")
+                firmas_embeds[sesion.embed_reservas_message.id] = firma
         else:
-            embed_reservas_message = await channel.send(embed=embed_reservas)
+            sesion.embed_reservas_message = await channel.send(embed=embed_reservas)
+            firmas_embeds[sesion.embed_reservas_message.id] = firma_embed(embed_reservas)
+            diario_sesiones.marcar(sesion)
+
+def firma_embed(embed):
+    """
+    Firma del contenido de un embed para saber si hace falta editarlo. La linea de la cuenta
+    atras se excluye: cambia cada segundo y por si sola no justifica una edicion.
+    """
+    datos = embed.to_dict()
+    pie = datos.get("footer", {}).get("text", "")
+    datos["footer"] = "\n".join(linea for linea in pie.split("\n") if not linea.startswith("⏳"))
+    return hash(json.dumps(datos, sort_keys=True, ensure_ascii=False))
+
+class ActualizadorEmbeds:
+    """
+    Agrupa cualquier numero de cambios de la lista en como mucho una edicion de los embeds por intervalo.
+
+    solicitar() solo marca que hay cambios pendientes. Una unica tarea pinta la lista en cuanto
+    puede y despues espera el intervalo; si durante ese tiempo llegan mas cambios vuelve a pintar,
+    de modo que el estado final de una rafaga siempre acaba en los embeds. Los refrescos de la
+    cuenta atras del planificador entran por aqui y se pintan junto a los cambios que coincidan.
+    """
+
+    def __init__(self, sesion, intervalo=2):
+        self.sesion = sesion
+        self.intervalo = intervalo
+        self.pendiente = asyncio.Event()
+        self.cuenta_atras = False
+        self.tarea = None
+        self.cancelado = False
+
+    @property
+    def iniciado(self):
+        """Si ya se ha pedido el primer pintado de la lista; antes no hay embeds que actualizar."""
+        return self.tarea is not None
+
+    def solicitar(self, cuenta_atras=False):
+        if self.cancelado:  # La lista se esta cerrando: nada puede pisar el embed de lista cerrada
+            return
+        self.cuenta_atras = self.cuenta_atras or cuenta_atras
+        self.pendiente.set()
+        if self.tarea is None or self.tarea.done():
+            self.tarea = asyncio.create_task(self._bucle())
+
+    def cancelar(self):
+        self.cancelado = True
+        self.pendiente.clear()
+        self.cuenta_atras = False
+        if self.tarea is not None and not self.tarea.done():
+            self.tarea.cancel()
+        self.tarea = None
+
+    async def _bucle(self):
+        while not self.sesion.lista_cerrada:
+            await self.pendiente.wait()
+            self.pendiente.clear()
+            cuenta_atras, self.cuenta_atras = self.cuenta_atras, False
+            try:
+                await actualizar_embeds(self.sesion, cuenta_atras)
+            except discord.HTTPException as error:
+                log.error("Error al actualizar los embeds: %s", error, extra={"sesion": self.sesion.clave})
+            except Exception:
+                # Un fallo al pintar no puede acabar con la tarea o la lista ya no se actualizaria
+                log.exception("Error inesperado al actualizar los embeds", extra={"sesion": self.sesion.clave})
+            await asyncio.sleep(self.intervalo)
 
 #################################################################################################
 
-def generar_embeds(miembros_lista=None, max_jugadores=None, fecha_lista=None, is_historico=False):
+def generar_embeds(miembros_lista=None, max_jugadores=None, fecha_lista=None, is_historico=False, sesion=None):
     """
     Genera embeds para listas de jugadores, tanto en tiempo real como historicas.
     Usa 'si' y 'no' para estados de conexion.
 
     Args:
-        miembros_lista (dict, optional): Diccionario con jugadores y estados.
+        miembros_lista (Roster | dict | list, optional): Roster, diccionario con jugadores y estados, o lista de pares (nombre, estado).
         max_jugadores (int, optional): Numero maximo de jugadores principales.
         fecha_lista (str, optional): Fecha de la lista (YYYY-MM-DD HH:MM:SS).
         is_historico (bool): Si True, muestra lista cerrada sin tiempo restante.
+        sesion (EventSession, optional): Sesion abierta de la que se toman la lista, el maximo y el tiempo.
 
     Returns:
         tuple: (embed_main, embed_reservas) o (embed_main, None).
     """
-    global MAX_JUGADORES, MAX_TIME_LIST, tiempo_inicio_lista
-
-    # Usar valores globales si no se proporcionan
-    miembros_lista = miembros_lista or globals().get('miembros_lista', {})
-    max_jugadores = max_jugadores or MAX_JUGADORES
+    # Usar los valores de la sesion si no se proporcionan; la lista activa va por id y se muestra con el nombre actual
+    if isinstance(miembros_lista, Roster):
+        roster = miembros_lista
+    elif miembros_lista:
+        roster = Roster(miembros_lista.items() if isinstance(miembros_lista, dict) else miembros_lista)
+    elif sesion is not None:
+        roster = sesion.miembros_lista
+    else:
+        roster = Roster()
+    max_jugadores = max_jugadores or (sesion.max_jugadores if sesion is not None else MAX_JUGADORES)
 
-    # Crear los embeds
-    miembros_principales = list(miembros_lista.items())[:max_jugadores]
-    miembros_reservas = list(miembros_lista.items())[max_jugadores:]
+    # Crear los embeds; las columnas vienen ya unidas del roster
+    principal = roster.seccion(max_jugadores)
+    reservas = roster.seccion(max_jugadores, reservas=True)
     
     embed_main = discord.Embed(title="📋 Lista de Jugadores", color=discord.Color.blue())
-    embed_reservas = discord.Embed(title="📝 Reservas", color=discord.Color.orange()) if miembros_reservas else None
-    
-    # Procesar jugadores principales
-    if miembros_principales:
-        numeros, nombres, estados = [], [], []
-        for index, (miembro, estado) in enumerate(miembros_principales, 1):
-            numeros.append(str(index))
-            nombres.append(miembro)
-            is_connected = estado == "si"
-            estados.append(f"{'🟢' if is_connected else '🔴'} {'Conectado' if is_connected else 'Desconectado'}")
-        
-        embed_main.add_field(name="#️⃣ Nº", value="\n".join(numeros) or "N/A", inline=True)
-        embed_main.add_field(name="👤 Nombre", value="\n".join(nombres) or "N/A", inline=True)
-        embed_main.add_field(name="🔹 Estado", value="\n".join(estados) or "N/A", inline=True)
+    embed_reservas = discord.Embed(title="📝 Reservas", color=discord.Color.orange()) if reservas else None
     
-    # Procesar reservas
-    if miembros_reservas:
-        numeros, nombres, estados = [], [], []
-        for index, (miembro, estado) in enumerate(miembros_reservas, max_jugadores + 1):
-            numeros.append(str(index))
-            nombres.append(miembro)
-            is_connected = estado == "si"
-            estados.append(f"{'🟢' if is_connected else '🔴'} {'Conectado' if is_connected else 'Desconectado'}")
-        
-        embed_reservas.add_field(name="#️⃣ Nº", value="\n".join(numeros) or "N/A", inline=True)
-        embed_reservas.add_field(name="👤 Nombre", value="\n".join(nombres) or "N/A", inline=True)
-        embed_reservas.add_field(name="🔹 Estado", value="\n".join(estados) or "N/A", inline=True)
+    for embed, columnas in ((embed_main, principal), (embed_reservas, reservas)):
+        if columnas:
+            numeros, nombres, estados = columnas
+            embed.add_field(name="#️⃣ Nº", value=numeros, inline=True)
+            embed.add_field(name="👤 Nombre", value=nombres or "N/A", inline=True)
+            embed.add_field(name="🔹 Estado", value=estados, inline=True)
     
-    # Contar jugadores conectados y desconectados
-    total_si = sum(1 for estado in miembros_lista.values() if estado == "si")
-    total_no = sum(1 for estado in miembros_lista.values() if estado == "no")
+    total_si = roster.conectados
+    total_no = roster.desconectados
 
     # Configurar el pie de pagina
     if is_historico:
@@ -333,13 +1903,13 @@ def generar_embeds(miembros_lista=None, max_jugadores=None, fecha_lista=None, is
             fecha_formateada = fecha_lista or "Desconocida"
         footer_text = f"⛔ Lista Cerrada\n📅 Fecha de la partida: {fecha_formateada}\n🟢 Conectados: {total_si} | 🔴 Desconectados: {total_no}"
     else:
-        if tiempo_inicio_lista is None:
+        if sesion is None or sesion.tiempo_inicio_lista is None:
             tiempo_restante_texto = "⏳ Tiempo no disponible"
         else:
-            tiempo_transcurrido = time.time() - tiempo_inicio_lista
-            tiempo_restante = max(0, MAX_TIME_LIST - tiempo_transcurrido)
-            minutos_restantes = int(tiempo_restante) // 60
-            segundos_restantes = int(tiempo_restante) % 60
+            tiempo_transcurrido = time.time() - sesion.tiempo_inicio_lista
+            tiempo_restante = round(max(0, sesion.max_time - tiempo_transcurrido))
+            minutos_restantes = tiempo_restante // 60
+            segundos_restantes = tiempo_restante % 60
             tiempo_restante_texto = f"⏳ La lista se cerrará en {minutos_restantes}m {segundos_restantes}s"
         fecha_formateada = datetime.now().strftime("%H:%M %d-%m-%Y")
         footer_text = f"{tiempo_restante_texto}\n📅 Fecha de la partida: {fecha_formateada}\n🟢 Conectados: {total_si} | 🔴 Desconectados: {total_no}"
@@ -350,200 +1920,469 @@ def generar_embeds(miembros_lista=None, max_jugadores=None, fecha_lista=None, is
 
 #################################################################################################
 
-async def enviar_mensajes_privados(ctx):
-    global miembros_lista, miembros_objetos, ROL_ID_JUGADORES  # Asegúrate de incluir ROL_ID_JUGADORES en las variables globales
-    
-    # Lista de miembros desconectados
-    desconectados = [miembro for miembro, estado in miembros_lista.items() if estado == "no"]
-    
-    for miembro in desconectados:
-        try:
-            # Verificar si el miembro está desconectado en cada iteración
-            if miembros_lista.get(miembro) != "no":  # Si el miembro ya está conectado, saltar al siguiente
-                print(f"{miembro} ya está conectado. No se enviará mensaje.")
-                continue  # Saltar al siguiente miembro
-
-            # Verificar si el miembro está en la lista de miembros con rol
-            member_obj = miembros_objetos.get(miembro)
-            
-            if not member_obj:  # Si el miembro no tiene el rol, no enviar el mensaje
-                print(f"{miembro} no tiene el rol adecuado. No se enviará mensaje.")
-                continue  # Saltar al siguiente miembro si no tiene el rol adecuado
-
-            # Intentar enviar el mensaje privado solo si el miembro tiene el rol
-            print(f"Intentando enviar mensaje privado a {miembro}")  # Mensaje de depuración
-
-            embed_msg = discord.Embed(
-                title=f"**{ctx.guild.name}**",
-                description="**¡Atención!**\n📢 La reunión para la partida ha comenzado.\n"
-                            "⏳ Conéctate cuanto antes para no quedarte fuera.\n\n"
-                            ":boom: Únete al canal de voz lo antes posible para no perderte la acción. ¡Te esperamos! :boom:",
-                color=discord.Color.red()
-            )
-            embed_msg.add_field(name="🎤 Canal de voz:", value=f"<#{VOICE_CH_ID}>", inline=False)  # Canal de voz
-            embed_msg.add_field(name="🔔 Tu estado actual:", value="Desconectado :x:", inline=False)
-            embed_msg.add_field(name="📌 Consulta tu estado en:", value=f"<#{int(config['channel_default'])}>", inline=False)  # Nueva línea con el canal
-            embed_msg.set_footer(text=f"Enviado a las {datetime.now().strftime('%H:%M:%S del %d-%m-%Y')}")
-            
-            await member_obj.send(embed=embed_msg)  # Enviar mensaje privado
-            print(f"Mensaje privado enviado a {miembro}")  # Confirmación de envío
-            await asyncio.sleep(5)  # Esperar 5 segundos entre cada mensaje
+def embed_mensaje_privado(guild_name, channel_id, restante=None):
+    if restante is None:
+        aviso = "📢 La reunión para la partida ha comenzado.\n⏳ Conéctate cuanto antes para no quedarte fuera."
+    else:
+        aviso = f"📢 Sigues desconectado y la lista se cierra en {restante // 60}m {restante % 60}s.\n⏳ Conéctate antes del cierre para no quedarte fuera."
+    embed_msg = discord.Embed(
+        title=f"**{guild_name}**",
+        description=f"**¡Atención!**\n{aviso}\n\n"
+                    ":boom: Únete al canal de voz lo antes posible para no perderte la acción. ¡Te esperamos! :boom:",
+        color=discord.Color.red()
+    )
+    embed_msg.add_field(name="🎤 Canal de voz:", value=f"<#{VOICE_CH_ID}>", inline=False)  # Canal de voz
+    embed_msg.add_field(name="🔔 Tu estado actual:", value="Desconectado :x:", inline=False)
+    embed_msg.add_field(name="📌 Consulta tu estado en:", value=f"<#{channel_id}>", inline=False)  # Nueva línea con el canal
+    embed_msg.set_footer(text=f"Enviado a las {datetime.now().strftime('%H:%M:%S del %d-%m-%Y')}")
+    return embed_msg
+
+class DespachadorMensajes:
+    """
+    Cola de mensajes privados en segundo plano con concurrencia limitada.
 
-        except discord.Forbidden:
-            print(f"⚠️ No se pudo enviar mensaje privado a {miembro}. Permisos denegados.")
+    La concurrencia se ajusta con lo que responde Discord: si un envio tarda mucho (discord.py
+    ha tenido que esperar a un limite) o devuelve 429 se reduce a la mitad, y con cada envio
+    rapido vuelve a subir de uno en uno. Los canales de DM se guardan para no repetir create_dm
+    y un mensaje pendiente se anula en cuanto el miembro se conecta.
+    """
 
-#################################################################################################
+    ENVIO_LENTO = 2.0  # Segundos a partir de los cuales un envio se considera frenado por limites
+
+    def __init__(self, concurrencia_max=4):
+        self.concurrencia_max = concurrencia_max
+        self.limite = concurrencia_max
+        self.en_curso = 0
+        self.cola = asyncio.Queue()
+        self.condicion = None
+        self.trabajadores = []
+        self.pendientes = {}  # (clave de la sesion, id del miembro) -> momento en que se encolo
+        self.canales_dm = {}  # id del miembro -> DMChannel
+        self.entregas = {}  # clave de la sesion -> {id del miembro -> (estado, latencia en segundos o None)}
+
+    def encolar(self, sesion, member, guild_name, restante=None):
+        # Quien esta en varias listas recibe un mensaje por cada una
+        if (sesion.clave, member.id) in self.pendientes:
+            return
+        if not self.trabajadores:
+            self.condicion = asyncio.Condition()
+            self.trabajadores = [asyncio.create_task(self._trabajador()) for _ in range(self.concurrencia_max)]
+        self.pendientes[(sesion.clave, member.id)] = time.monotonic()
+        self.entregas.setdefault(sesion.clave, {})[member.id] = ("pendiente", None)
+        self.cola.put_nowait((sesion.clave, member, guild_name, restante))
+
+    def olvidar(self, clave):
+        """Borra las entregas de una sesion; se llama al abrir en ella una lista nueva."""
+        self.entregas.pop(clave, None)
+
+    def cancelar(self, sesion, member_id, motivo):
+        """Anula el mensaje pendiente de `member_id` para la lista de `sesion`; las demas listas no cambian."""
+        if self.pendientes.pop((sesion.clave, member_id), None) is not None:
+            self.entregas.setdefault(sesion.clave, {})[member_id] = ("cancelado", None)
+            usuario = bot.get_user(member_id)
+            log.info("Mensaje privado a %s cancelado: %s.", usuario.display_name if usuario else member_id, motivo,
+                     extra={"sesion": sesion.clave, "miembro": member_id})
+
+    async def _trabajador(self):
+        while True:
+            clave, member, guild_name, restante = await self.cola.get()
+            try:
+                if (clave, member.id) in self.pendientes:  # Si no esta, se ha cancelado mientras esperaba
+                    async with self.condicion:
+                        await self.condicion.wait_for(lambda: self.en_curso < self.limite)
+                        self.en_curso += 1
+                    try:
+                        await self._enviar(clave, member, guild_name, restante)
+                    finally:
+                        async with self.condicion:
+                            self.en_curso -= 1
+                            self.condicion.notify_all()
+            finally:
+                self.cola.task_done()
+
+    async def _enviar(self, clave, member, guild_name, restante):
+        # Comprobar otra vez justo antes de enviar, la espera puede haber sido larga
+        encolado = self.pendientes.pop((clave, member.id), None)
+        if encolado is None:
+            return
+        channel_id = clave[1]
+        entregas = self.entregas.setdefault(clave, {})
+        log.debug("Intentando enviar mensaje privado a %s", member.display_name, extra={"miembro": member.id})
+        inicio = time.monotonic()
+        try:
+            canal = self.canales_dm.get(member.id)
+            if canal is None:
+                canal = await member.create_dm()
+                self.canales_dm[member.id] = canal
+            await canal.send(embed=embed_mensaje_privado(guild_name, channel_id, restante))
+        except discord.Forbidden:
+            entregas[member.id] = ("prohibido", None)
+            metricas.contar("mensajes_privados_total", estado="prohibido")
+            log.warning("No se pudo enviar mensaje privado a %s. Permisos denegados.", member.display_name, extra={"miembro": member.id})
+            return
+        except discord.HTTPException as error:
+            if error.status == 429:
+                # Discord ha agotado los reintentos de discord.py: bajar el ritmo y volver a intentarlo
+                self._frenar()
+                metricas.contar("mensajes_privados_total", estado="reintento")
+                self.pendientes[(clave, member.id)] = encolado
+                self.cola.put_nowait((clave, member, guild_name, restante))
+                return
+            entregas[member.id] = ("error", None)
+            metricas.contar("mensajes_privados_total", estado="error")
+            log.warning("Error al enviar mensaje privado a %s: %s", member.display_name, error, extra={"miembro": member.id})
+            return
 
-@bot.command(name="AddPlayers")
-async def add_players(ctx, member=None, modo="manual"):
-    global miembros_lista, miembros_objetos
+        duracion = time.monotonic() - inicio
+        if duracion >= self.ENVIO_LENTO:
+            self._frenar()
+        elif self.limite < self.concurrencia_max:
+            self.limite += 1
+        entregas[member.id] = ("enviado", time.monotonic() - encolado)
+        metricas.contar("mensajes_privados_total", estado="enviado")
+        log.info("Mensaje privado enviado a %s", member.display_name, extra={"miembro": member.id})
+
+    def _frenar(self):
+        self.limite = max(1, self.limite // 2)
+
+    def resumen(self, claves):
+        """Devuelve ({estado: cantidad}, [latencias de los entregados]) de las sesiones `claves`."""
+        cantidades = {}
+        latencias = []
+        for clave in claves:
+            for estado, latencia in self.entregas.get(clave, {}).values():
+                cantidades[estado] = cantidades.get(estado, 0) + 1
+                if latencia is not None:
+                    latencias.append(latencia)
+        return cantidades, sorted(latencias)
+
+despachador_mensajes = DespachadorMensajes()
+
+def encolar_mensajes_privados(sesion, guild, restante=None):
+    """
+    Encola un mensaje privado para cada jugador con rol que siga desconectado. No espera a que se envien.
+    Con `restante` el mensaje es un recordatorio de los segundos que faltan para el cierre.
+    """
+    for miembro in sesion.miembros_lista:
+        if sesion.miembros_lista.conectado(miembro):
+            continue
 
-    # Determinar si ctx es un canal, un hilo o un contexto de comando
-    try:
-        if isinstance(ctx, discord.TextChannel):
-            channel = ctx
-        elif isinstance(ctx, discord.Thread):
-            channel = ctx.parent  # Usar el canal padre del hilo
-        elif isinstance(ctx, commands.Context):
-            channel = ctx.channel
-        else:
-            channel = bot.get_channel(int(config['channel_default']))
-    except Exception as e:
-        print(f"Error al determinar el canal: {e}")
-        return
+        # Verificar si el miembro está en la lista de miembros con rol
+        member_obj = sesion.miembros_objetos.get(miembro)
+        if not es_jugador(member_obj):  # Si el miembro no tiene el rol, no enviar el mensaje
+            log.info("%s no tiene el rol adecuado. No se enviará mensaje.", sesion.nombre_en_lista(miembro), extra={"sesion": sesion.clave})
+            continue
 
-    print(f"Tipo de ctx: {type(ctx)}, Canal: {channel}")  # Depuración
+        despachador_mensajes.encolar(sesion, member_obj, guild.name, restante)
 
-    # Obtener los miembros conectados a los canales de voz en ese momento
-    connected_members = {m.display_name: m for guild in bot.guilds for channel in guild.voice_channels for m in channel.members}
+#################################################################################################
 
-    if modo == "automatico":
-        if member is None:
-            print("Error: Modo automático requiere un miembro.")
-            return
-        miembro = member.display_name
-        if miembro not in miembros_lista:  # Evitar duplicados
-            miembros_lista[miembro] = "si"
-            miembros_objetos[miembro] = connected_members[miembro]  # Usar nombre como clave
-            print(f"Se ha añadido correctamente el jugador: {miembro}")
-
-    elif modo == "manual":
-        if not isinstance(ctx, commands.Context):
-            print("Error: Modo manual requiere un contexto de comando.")
-            return
-        if not miembros_lista:
-            await ctx.send(":red_circle: No hay una lista activa para agregar jugadores.")
+async def añadir_jugador_automatico(sesion, member):
+    """
+    Añade a la lista de la sesion a quien entra en el canal de reservas. Un miembro que ya se
+    esta añadiendo no se vuelve a procesar aunque lleguen varios eventos seguidos.
+    """
+    async with sesion.adding_lock:
+        if not sesion.admite_cambios or member.id in sesion.adding_players or member.id in sesion.miembros_lista:
             return
+        sesion.adding_players.add(member.id)
+    try:
+        sesion.añadir(member.id, True, member)
+        log.info("Añadido automáticamente %s desde canal de reservas", member.display_name, extra={"sesion": sesion.clave, "miembro": member.id})
+        sesion.actualizador.solicitar()
+    finally:
+        sesion.adding_players.discard(member.id)
+
+@bot.tree.command(name="addplayers", description="Añade jugadores a la lista abierta en este canal")
+@app_commands.check(es_admin_en_canal_eventos)
+async def add_players(interaction: discord.Interaction):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is None or not sesion.admite_cambios:
+        await interaction.response.send_message(":red_circle: No hay una lista activa para agregar jugadores.", ephemeral=True)
+        return
+    await interaction.response.send_modal(ModalJugadores("Añadir jugadores", añadir_a_lista))
 
-        await ctx.send("✍ Escribe los nombres de los jugadores uno por uno. Escribe `FIN` para confirmar.")
-
-        def check(m):
-            return m.author == ctx.author and m.channel == ctx.channel
-
-        while True:
-            try:
-                msg = await bot.wait_for("message", check=check, timeout=60.0)
-            except asyncio.TimeoutError:
-                await ctx.send("⏳ Tiempo de espera agotado. No se añadieron jugadores.")
-                return
+async def añadir_a_lista(interaction, texto):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is None or not sesion.admite_cambios:  # Se ha cerrado mientras se rellenaba el formulario
+        await interaction.response.send_message(":red_circle: La lista ya no está abierta.", ephemeral=True)
+        return
 
-            if msg.content.strip().upper() == "FIN":
-                break
-
-            jugadores = msg.content.strip().splitlines()
-            for jugador in jugadores:
-                jugador = jugador.strip()
-                if jugador:
-                    if jugador in miembros_lista:
-                        await ctx.send(f"⚠️ `{jugador}` ya está en la lista.")
-                    else:
-                        if jugador in connected_members:
-                            miembros_lista[jugador] = "si"
-                            miembros_objetos[jugador] = connected_members[jugador]
-                            print(f"Se ha añadido correctamente el jugador: {jugador}")
-                        else:
-                            miembros_lista[jugador] = "no"
-            await msg.delete()
-
-    await eliminar_jugadores_no_en_lista(channel)
-    await actualizar_embeds(channel)
+    antes = len(sesion.miembros_lista)
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    avisos = await añadir_nombres(sesion, interaction.guild, texto)
+    await interaction.followup.send(f"✅ {len(sesion.miembros_lista) - antes} jugadores añadidos.{texto_avisos(*avisos)}", ephemeral=True)
+    sesion.actualizador.solicitar()
+    await confirmar_sugeridos(interaction, sesion, avisos[3])
     
 #################################################################################################
 
-@bot.command()
-async def CancelList(ctx):
-    global miembros_lista, miembros_objetos, embed_main_message, embed_reservas_message, lista_cerrada, tarea_cerrar_lista
+@bot.tree.command(name="cancellist", description="Cancela la lista abierta en este canal sin guardarla")
+@app_commands.check(es_admin_en_canal_eventos)
+async def CancelList(interaction: discord.Interaction):
+    sesion = sesiones.de_contexto(interaction)
     
-    if lista_cerrada:
-        await ctx.send("⚠️ No puedes cancelar la lista porque aún no está abierta.")
+    if sesion is None or sesion.lista_cerrada:
+        await interaction.response.send_message("⚠️ No puedes cancelar la lista porque aún no está abierta.", ephemeral=True)
         return
     
-    await ctx.send("❗ ¿Estás seguro de que quieres cancelar la lista? Responde 'CONFIRMAR' para proceder.")
-    
-    def check(m):
-        return m.author == ctx.author and m.content.upper() == "CONFIRMAR"
-    
-    try:
-        await bot.wait_for("message", check=check, timeout=30)
-    except asyncio.TimeoutError:
-        await ctx.send("⚠️ Cancelación abortada. No se recibió confirmación a tiempo.")
+    if not await confirmar(interaction, "❗ ¿Estás seguro de que quieres cancelar la lista?"):
+        await interaction.edit_original_response(content="⚠️ Cancelación abortada.", view=None)
         return
     
+    # Mientras se borran los embeds ningun evento debe volver a pintarlos
+    sesiones.retirar(sesion)
+    sesion.actualizador.cancelar()
     try:
-        if embed_reservas_message:
-            await embed_reservas_message.delete()
-            embed_reservas_message = None
-        if embed_main_message:  # Cambié elif por if para asegurar que ambos se borren si existen
-            await embed_main_message.delete()
-            embed_main_message = None
+        if sesion.embed_reservas_message:
+            await sesion.embed_reservas_message.delete()
+            sesion.embed_reservas_message = None
+        if sesion.embed_main_message:  # Cambié elif por if para asegurar que ambos se borren si existen
+            await sesion.embed_main_message.delete()
+            sesion.embed_main_message = None
     except discord.NotFound:
-        await ctx.send("⚠️ No se encontró el mensaje del embed, pero se reiniciará la lista igualmente.")
+        log.warning("No se encontró el mensaje del embed, pero se reiniciará la lista igualmente.", extra={"sesion": sesion.clave})
     
-    if tarea_cerrar_lista and not tarea_cerrar_lista.done():
-        tarea_cerrar_lista.cancel()
+    for member_id in sesion.miembros_objetos:
+        despachador_mensajes.cancelar(sesion, member_id, "la lista se ha cancelado")
+    if sesion.tarea_cerrar_lista and not sesion.tarea_cerrar_lista.done():
+        sesion.tarea_cerrar_lista.cancel()
         try:
-            await tarea_cerrar_lista
+            await sesion.tarea_cerrar_lista
         except asyncio.CancelledError:
-            print("Tarea de cierre automático cancelada en CancelList")
-    tarea_cerrar_lista = None
+            log.debug("Cierre en curso cancelado en CancelList", extra={"sesion": sesion.clave})
+    sesion.tarea_cerrar_lista = None
     
-    miembros_lista.clear()
-    miembros_objetos.clear()
-    lista_cerrada = True
-    await ctx.send("✅ La lista ha sido cancelada correctamente.")
+    sesiones.cerrar(sesion)
+    sesion.reiniciar()
+    await interaction.edit_original_response(content="✅ La lista ha sido cancelada correctamente.")
 
 #################################################################################################
 
-@bot.command()
-async def FinishList(ctx):
-    global MAX_TIME_LIST, tarea_cerrar_lista
+@bot.tree.command(name="finishlist", description="Cierra y guarda ya la lista abierta en este canal")
+@app_commands.check(es_admin_en_canal_eventos)
+async def FinishList(interaction: discord.Interaction):
+    sesion = sesiones.de_contexto(interaction)
 
-    if lista_cerrada:
-        await ctx.send("No hay ninguna lista que cerrar.")
+    if sesion is None or sesion.lista_cerrada:
+        await interaction.response.send_message("No hay ninguna lista que cerrar.", ephemeral=True)
         return
 
-    await ctx.send("¿Estás seguro de que quieres cerrar la lista? Escribe `CONFIRMAR` para proceder.")
-    
-    def check(message):
-        return message.author == ctx.author and message.content.upper() == "CONFIRMAR"
-    
-    try:
-        await bot.wait_for('message', check=check, timeout=30.0)
-    except asyncio.TimeoutError:
-        await ctx.send("No se recibió confirmación a tiempo. La operación ha sido cancelada.")
+    if not await confirmar(interaction, "¿Estás seguro de que quieres cerrar la lista?"):
+        await interaction.edit_original_response(content="La operación ha sido cancelada.", view=None)
         return
     
-    print("Estado antes de cerrar_lista:", "tarea_cerrar_lista =", tarea_cerrar_lista, "lista_cerrada =", lista_cerrada)
-    await cerrar_lista(1)
-    print("Estado después de cerrar_lista:", "tarea_cerrar_lista =", tarea_cerrar_lista, "lista_cerrada =", lista_cerrada)
-    MAX_TIME_LIST = int(os.environ['MAX_TIME'])
+    await interaction.edit_original_response(content="⏳ Cerrando la lista...")
+    log.info("Cierre manual de la lista", extra={"sesion": sesion.clave, "miembro": interaction.user.id})
+    await cerrar_lista(sesion)
 
 #################################################################################################
 
+@bot.tree.command(name="extendlist", description="Amplía el tiempo que queda para que se cierre la lista de este canal")
+@app_commands.describe(minutos="Minutos que se añaden al tiempo de la lista")
+@app_commands.check(es_admin_en_canal_eventos)
+async def ExtendList(interaction: discord.Interaction, minutos: app_commands.Range[int, 1, 240]):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is None or not sesion.admite_cambios:
+        await interaction.response.send_message("No hay ninguna lista abierta que ampliar.", ephemeral=True)
+        return
+
+    sesion.max_time += minutos * 60
+    diario_sesiones.marcar(sesion)
+    planificador.programar(sesion)  # Los recordatorios que ya se enviaron se repiten si vuelven a quedar por delante
+    sesion.actualizador.solicitar(cuenta_atras=True)
+    restante = int(planificador.restante(sesion))
+    log.info("Lista ampliada %s minutos", minutos, extra={"sesion": sesion.clave, "miembro": interaction.user.id})
+    await interaction.response.send_message(f"✅ Lista ampliada {minutos} minutos. Se cerrará en {restante // 60}m {restante % 60}s.", ephemeral=True)
+
+#################################################################################################
+
+@bot.tree.command(name="removeplayer", description="Quita a un jugador de la lista abierta en este canal")
+@app_commands.describe(jugador="Nombre del jugador tal como aparece en la lista")
+@app_commands.check(es_admin_en_canal_eventos)
+async def RemovePlayer(interaction: discord.Interaction, jugador: str):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is None or not sesion.admite_cambios:
+        await interaction.response.send_message("No hay ninguna lista abierta en este canal.", ephemeral=True)
+        return
+    clave = sesion.clave_de_nombre(jugador)
+    if clave is None:
+        await interaction.response.send_message(f"⚠️ `{jugador}` no está en la lista.", ephemeral=True)
+        return
+
+    nombre = sesion.nombre_en_lista(clave)
+    sesion.quitar(clave)
+    sesion.actualizador.solicitar()
+    log.info("%s quitado de la lista", nombre, extra={"sesion": sesion.clave, "miembro": interaction.user.id})
+    await interaction.response.send_message(f"✅ {nombre} se ha quitado de la lista.", ephemeral=True)
+
+@bot.tree.command(name="moveplayer", description="Cambia la posición de un jugador en la lista abierta en este canal")
+@app_commands.describe(jugador="Nombre del jugador tal como aparece en la lista", posicion="Nueva posición, empezando por 1")
+@app_commands.check(es_admin_en_canal_eventos)
+async def MovePlayer(interaction: discord.Interaction, jugador: str, posicion: app_commands.Range[int, 1]):
+    sesion = sesiones.de_contexto(interaction)
+    if sesion is None or not sesion.admite_cambios:
+        await interaction.response.send_message("No hay ninguna lista abierta en este canal.", ephemeral=True)
+        return
+    clave = sesion.clave_de_nombre(jugador)
+    if clave is None:
+        await interaction.response.send_message(f"⚠️ `{jugador}` no está en la lista.", ephemeral=True)
+        return
+
+    posicion = min(posicion, len(sesion.miembros_lista))
+    nombre = sesion.nombre_en_lista(clave)
+    sesion.mover(clave, posicion - 1)
+    sesion.actualizador.solicitar()
+    log.info("%s movido al puesto %s", nombre, posicion, extra={"sesion": sesion.clave, "miembro": interaction.user.id})
+    reserva = " (reservas)" if posicion > sesion.max_jugadores else ""
+    await interaction.response.send_message(f"✅ {nombre} está ahora en el puesto {posicion}{reserva}.", ephemeral=True)
+
+#################################################################################################
+
+class FiltrosListas(commands.FlagConverter, delimiter=' ', prefix='-'):
+    jugador: str = None
+    desde: str = None  # YYYY-MM-DD
+    hasta: str = None  # YYYY-MM-DD, incluido
+
+class CacheRosters:
+    """
+    Cache LRU acotada de jugadores de listas cerradas, por idLista. Una lista cerrada no cambia,
+    asi que no hace falta invalidarla: solo se descartan las menos usadas al llenarse.
+    """
+
+    def __init__(self, capacidad=256):
+        self.capacidad = capacidad
+        self.rosters = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, id_lista):
+        roster = self.rosters.get(id_lista)
+        if roster is None:
+            self.fallos += 1
+            return None
+        self.rosters.move_to_end(id_lista)
+        self.aciertos += 1
+        return roster
+
+    def guardar(self, id_lista, roster):
+        self.rosters[id_lista] = roster
+        self.rosters.move_to_end(id_lista)
+        if len(self.rosters) > self.capacidad:
+            self.rosters.popitem(last=False)
+
+cache_rosters = CacheRosters()
+
+async def cargar_roster_lista(id_lista, datos_lista, formato_datos=0):
+    """
+    Devuelve los jugadores de una lista como Roster, que guarda ya unidas las columnas del embed.
+    Primero se mira la cache; si no, se leen de ListaJugadores por su clave primaria y DatosLista
+    solo se usa si la lista no tiene filas.
+    """
+    roster = cache_rosters.obtener(id_lista)
+    if roster is not None:
+        return roster
+    filas = await sql_fetch("SELECT Nombre, Estado FROM ListaJugadores WHERE idLista = ? ORDER BY Posicion;", (id_lista,))
+    if filas:
+        roster = Roster(filas)
+    else:
+        datos = json.loads(datos_lista) if formato_datos >= FORMATO_DATOS_ACTUAL else fix_json(datos_lista)
+        roster = Roster(datos.items())
+    cache_rosters.guardar(id_lista, roster)
+    return roster
+
+class VisorListas(discord.ui.View):
+    """
+    Muestra el historico de listas de una en una en un unico mensaje con botones para moverse.
+    Cada pagina es una consulta por clave (idLista) que usa el indice, nunca un OFFSET.
+    """
+
+    def __init__(self, autor, condiciones, parametros, total):
+        super().__init__(timeout=300)
+        self.autor = autor
+        self.condiciones = condiciones
+        self.parametros = parametros
+        self.total = total
+        self.posicion = 0
+        self.id_actual = None
+        self.mensaje = None
+
+    async def buscar(self, mas_antigua):
+        """Busca la lista siguiente en la direccion pedida. Devuelve (fila, hay_mas) o (None, False)."""
+        condiciones = list(self.condiciones)
+        parametros = list(self.parametros)
+        if self.id_actual is not None:
+            condiciones.append("idLista < ?" if mas_antigua else "idLista > ?")
+            parametros.append(self.id_actual)
+        where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        orden = "DESC" if mas_antigua else "ASC"
+        query = f"SELECT idLista, FechaLista, DatosLista, NumJugadores, FormatoDatos FROM Listas {where} ORDER BY idLista {orden} LIMIT 2;"
+        filas = await sql_fetch(query, tuple(parametros))
+        if not filas:
+            return None, False
+        return filas[0], len(filas) > 1
+
+    async def pagina(self, mas_antigua):
+        fila, hay_mas = await self.buscar(mas_antigua)
+        if fila is None:
+            return None
+        id_lista, fecha_lista, datos_lista, num_jugadores, formato_datos = fila
+        if self.id_actual is not None:
+            self.posicion += 1 if mas_antigua else -1
+        self.id_actual = id_lista
+        # Hacia atras siempre hay algo salvo en la primera; hacia delante lo dice la consulta
+        self.anterior.disabled = not hay_mas if mas_antigua else False
+        self.siguiente.disabled = self.posicion == 0
+
+        try:
+            jugadores = await cargar_roster_lista(id_lista, datos_lista, formato_datos)
+            embed_main, embed_reservas = generar_embeds(
+                miembros_lista=jugadores,
+                max_jugadores=num_jugadores,
+                fecha_lista=fecha_lista,
+                is_historico=True
+            )
+        except json.JSONDecodeError:
+            log.error("JSON inválido en lista %s: %s", fecha_lista, datos_lista)
+            embed_main = discord.Embed(title="⚠️ Lista dañada", description=f"Error al procesar la lista del {fecha_lista}: Datos inválidos.")
+            embed_reservas = None
+        contenido = f"📋 Lista {self.posicion + 1} de {self.total}"
+        return contenido, [embed for embed in (embed_main, embed_reservas) if embed]
+
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.autor.id:
+            await interaction.response.send_message("⚠️ Solo quien ha abierto el histórico puede moverse por él.", ephemeral=True)
+            return False
+        return True
+
+    async def mover(self, interaction, mas_antigua):
+        resultado = await self.pagina(mas_antigua)
+        if resultado is None:
+            await interaction.response.defer()
+            return
+        contenido, embeds = resultado
+        await interaction.response.edit_message(content=contenido, embeds=embeds, view=self)
+
+    @discord.ui.button(label="◀ Anterior", style=discord.ButtonStyle.secondary)
+    async def anterior(self, interaction, button):
+        await self.mover(interaction, mas_antigua=True)
+
+    @discord.ui.button(label="Siguiente ▶", style=discord.ButtonStyle.secondary)
+    async def siguiente(self, interaction, button):
+        await self.mover(interaction, mas_antigua=False)
+
+    async def on_timeout(self):
+        if self.mensaje:
+            try:
+                await self.mensaje.edit(view=None)
+            except discord.HTTPException:
+                pass
+
 @bot.command()
-async def ShowPastLists(ctx):
+async def ShowPastLists(ctx, *, filtros: FiltrosListas):
     """
-    Muestra todas las listas pasadas almacenadas en la base de datos, ordenadas de mas viejo a mas nuevo.
+    Muestra las listas pasadas de una en una, de la mas nueva a la mas vieja, con botones para moverse.
+    Filtros opcionales: -jugador NOMBRE -desde YYYY-MM-DD -hasta YYYY-MM-DD
     """
     # Verificar permisos de admin
     if ROL_ID_ADMINS not in [role.id for role in ctx.author.roles]:
@@ -556,399 +2395,783 @@ async def ShowPastLists(ctx):
         await ctx.send("⚠️ No se pudo encontrar el canal por defecto.")
         return
 
-    # Consultar listas, ordenadas de mas viejo a mas nuevo
-    query = "SELECT FechaLista, DatosLista, NumJugadores FROM Listas ORDER BY FechaLista ASC;"
-    listas = sql_fetch(query)
-    
-    if not listas:
+    condiciones, parametros = [], []
+    try:
+        if filtros.desde:
+            condiciones.append("FechaLista >= ?")
+            parametros.append(datetime.strptime(filtros.desde, "%Y-%m-%d").strftime("%Y-%m-%d"))
+        if filtros.hasta:
+            condiciones.append("FechaLista < date(?, '+1 day')")
+            parametros.append(datetime.strptime(filtros.hasta, "%Y-%m-%d").strftime("%Y-%m-%d"))
+    except ValueError:
+        await ctx.send("⚠️ Las fechas deben tener el formato YYYY-MM-DD.")
+        return
+    if filtros.jugador:
+        member = indices_nombres.de(ctx.guild.id).resolver(filtros.jugador)
+        condiciones.append("idLista IN (SELECT idLista FROM ListaJugadores WHERE IdDiscord = ? OR Nombre = ?)")
+        parametros.extend([member.id if member else None, filtros.jugador])
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    total = await sql_fetch(f"SELECT COUNT(*) FROM Listas {where};", tuple(parametros))
+    total = total[0][0] if total else 0
+    if not total:
         await ctx.send("📪 No hay listas registradas en la base de datos.")
         return
 
-    await ctx.send(f"📋 Mostrando {len(listas)} listas pasadas...")
+    visor = VisorListas(ctx.author, condiciones, parametros, total)
+    contenido, embeds = await visor.pagina(mas_antigua=True)
+    visor.mensaje = await channel.send(content=contenido, embeds=embeds, view=visor)
 
-    def fix_json(json_str):
-        """Repara JSON invalido reemplazando comillas simples."""
-        try:
-            json_str = re.sub(r"(?<!\\)'", '"', json_str)
-            return json.loads(json_str)
-        except json.JSONDecodeError as e:
-            logging.error(f"Error al reparar JSON: {json_str}, Error: {str(e)}")
-            raise
-
-    # Procesar cada lista
-    for fecha_lista, datos_lista, num_jugadores in listas:
-        try:
-            miembros_lista = fix_json(datos_lista)
-            embed_main, embed_reservas = generar_embeds(
-                miembros_lista=miembros_lista,
-                max_jugadores=num_jugadores,
-                fecha_lista=fecha_lista,
-                is_historico=True
+@bot.command()
+async def MigrateLists(ctx):
+    """
+    Reescribe una sola vez como JSON canonico los DatosLista guardados por versiones antiguas
+    y los marca con FORMATO_DATOS_ACTUAL para que no se vuelvan a reparar.
+    """
+    def migrar(con):
+        reparadas, fallidas = 0, []
+        filas = con.execute("SELECT idLista, DatosLista FROM Listas WHERE FormatoDatos < ?;", (FORMATO_DATOS_ACTUAL,)).fetchall()
+        for id_lista, datos_lista in filas:
+            try:
+                datos = fix_json(datos_lista)
+            except json.JSONDecodeError:
+                fallidas.append(id_lista)
+                continue
+            con.execute(
+                "UPDATE Listas SET DatosLista = ?, FormatoDatos = ? WHERE idLista = ?;",
+                (json.dumps(datos, ensure_ascii=False), FORMATO_DATOS_ACTUAL, id_lista)
             )
-            await channel.send(embed=embed_main)
-            if embed_reservas:
-                await channel.send(embed=embed_reservas)
-            await asyncio.sleep(1)
-        except json.JSONDecodeError:
-            await channel.send(f"⚠️ Error al procesar la lista del {fecha_lista}: Datos inválidos.")
-            logging.error(f"JSON inválido en lista {fecha_lista}: {datos_lista}")
-            continue
-        except Exception as e:
-            await channel.send(f"⚠️ Error al mostrar la lista del {fecha_lista}: {str(e)}")
-            logging.error(f"Error inesperado en lista {fecha_lista}: {str(e)}")
-            continue
+            reparadas += 1
+        return reparadas, fallidas
+
+    resultado = await sql_transaccion(migrar, "migracion de DatosLista")
+    if resultado is None:
+        await ctx.send("⚠️ No se pudo completar la migración de las listas.")
+        return
+    reparadas, fallidas = resultado
+    mensaje = f"✅ {reparadas} listas migradas al formato actual."
+    if fallidas:
+        mensaje += f"\n⚠️ No se pudieron reparar las listas: {', '.join(map(str, fallidas))}"
+    await ctx.send(mensaje)
 
 #################################################################################################
 
-async def cerrar_lista(tiempo_espera):
-    global lista_cerrada, tarea_cerrar_lista
-    
-    print("Iniciando cerrar_lista")
-    if lista_cerrada:
-        print("Lista ya cerrada, saliendo")
+@bot.tree.command(name="playerhistory", description="Muestra la asistencia de un jugador en las últimas listas")
+@app_commands.describe(jugador="Jugador del que ver el historial")
+@app_commands.check(es_admin_en_canal_eventos)
+async def PlayerHistory(interaction: discord.Interaction, jugador: discord.Member):
+    resultado = await sql_fetch(
+        "SELECT Listas, Asistencias, Ventana, RachaAsistencias, RachaAusencias, UltimaAsistencia FROM HistorialJugadores WHERE IdDiscord = ?;",
+        (jugador.id,)
+    )
+    if not resultado:
+        await interaction.response.send_message(f"📪 {jugador.display_name} no ha estado en ninguna lista.", ephemeral=True)
         return
-    
-    if tarea_cerrar_lista is not None:
-        if not tarea_cerrar_lista.done():
-            print("Cancelando tarea anterior")
-            tarea_cerrar_lista.cancel()
-            try:
-                await tarea_cerrar_lista  # Intentar esperar a que termine
-            except asyncio.CancelledError:
-                print("Tarea anterior cancelada exitosamente")
-        else:
-            print("Tarea anterior ya estaba terminada")
-        tarea_cerrar_lista = None  # Limpiar la tarea después de cancelarla
-    
-    print("Creando nueva tarea de cierre")
-    tarea_cerrar_lista = asyncio.create_task(proceso_cierre_lista(tiempo_espera))
-    await tarea_cerrar_lista
-    print("Cierre completado")
+
+    listas, asistencias, ventana, racha_asistencias, racha_ausencias, ultima_asistencia = resultado[0]
+    embed = discord.Embed(title=f"📋 Historial de {jugador.display_name}", color=discord.Color.blue())
+    embed.add_field(name="Listas", value=f"{listas} ({round(asistencias * 100 / listas, 2)}% conectado)", inline=False)
+    embed.add_field(name=f"Últimas {len(ventana)}", value=f"{ventana.count('1')}/{len(ventana)} conectado\n{ventana.replace('1', '🟢').replace('0', '🔴')}", inline=False)
+    if racha_ausencias:
+        racha = f"🔴 {racha_ausencias} listas seguidas sin conectarse"
+    else:
+        racha = f"🟢 {racha_asistencias} listas seguidas conectado"
+    embed.add_field(name="Racha actual", value=racha, inline=False)
+    if ultima_asistencia:
+        ultima_asistencia = datetime.strptime(ultima_asistencia, "%Y-%m-%d %H:%M:%S").strftime("%d-%m-%Y")
+    embed.add_field(name="Última vez conectado", value=ultima_asistencia or "Nunca", inline=False)
+    lineas = []
+    for _, fecha_lista, posicion, reserva, estado in await listas_de_jugador(jugador.id, limite=5):
+        fecha = datetime.strptime(fecha_lista, "%Y-%m-%d %H:%M:%S").strftime("%d-%m-%Y")
+        lineas.append(f"{'🟢' if estado in ('si', 'sí') else '🔴'} {fecha} · Nº {posicion}{' (reserva)' if reserva else ''}")
+    if lineas:
+        embed.add_field(name="Últimas listas", value="\n".join(lineas), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.command()
+async def RebuildHistory(ctx):
+    """
+    Rehace el historial de asistencia de todos los jugadores a partir de las listas guardadas.
+    """
+    jugadores = await sql_transaccion(reconstruir_historial, "reconstruccion del historial")
+    if jugadores is None:
+        await ctx.send("⚠️ No se pudo reconstruir el historial de los jugadores.")
+        return
+    await ctx.send(f"✅ Historial reconstruido para {jugadores} jugadores.")
 
 #################################################################################################
 
-async def proceso_cierre_lista(tiempo_espera):
-    global lista_cerrada, embed_main_message, embed_reservas_message
-    
-    print(f"Esperando {tiempo_espera} segundos en proceso_cierre_lista")
-    await asyncio.sleep(tiempo_espera)
-    
-    channel = bot.get_channel(int(config['channel_default']))
-    embed_main, embed_reservas = generar_embeds()
+async def cerrar_lista(sesion):
+    """
+    Cierra ya la lista. La llama el planificador al llegar la hora y /finishlist; si el cierre
+    ya esta en marcha se espera a ese en lugar de empezar otro.
+    """
+    if sesion.lista_cerrada:
+        log.debug("Lista ya cerrada, saliendo", extra={"sesion": sesion.clave})
+        return
+
+    planificador.cancelar(sesion)
+    if sesion.tarea_cerrar_lista is None:
+        sesion.tarea_cerrar_lista = asyncio.create_task(proceso_cierre_lista(sesion))
+    tarea = sesion.tarea_cerrar_lista
+    try:
+        await asyncio.shield(tarea)
+    finally:
+        if tarea.done() and sesion.tarea_cerrar_lista is tarea:
+            sesion.tarea_cerrar_lista = None
+
+#################################################################################################
+
+async def proceso_cierre_lista(sesion):
+    log.debug("Cerrando la lista", extra={"sesion": sesion.clave})
+
+    # Antes del primer await: desde aqui ningun evento llega a la lista ni pide otra actualizacion
+    # que pise el embed de lista cerrada
+    sesiones.retirar(sesion)
+    sesion.actualizador.cancelar()
+    channel = sesion.channel
+    embed_main, embed_reservas = generar_embeds(sesion=sesion)
+    miembros_lista = sesion.miembros_lista
     
     if embed_main:
-        embed_main.set_footer(text=f"⛔ Lista Cerrada\n{embed_main.footer.text.split('\n')[1]}\n🟢 Conectados: {sum(1 for estado in miembros_lista.values() if estado == 'si')} | 🔴 Desconectados: {sum(1 for estado in miembros_lista.values() if estado == 'no')}")
-        if embed_main_message:
-            await embed_main_message.edit(embed=embed_main)
+        embed_main.set_footer(text=f"⛔ Lista Cerrada\n{embed_main.footer.text.split('\n')[1]}\n🟢 Conectados: {miembros_lista.conectados} | 🔴 Desconectados: {miembros_lista.desconectados}")
+        if sesion.embed_main_message:
+            await sesion.embed_main_message.edit(embed=embed_main)
         else:
-            embed_main_message = await channel.send(embed=embed_main)
+            sesion.embed_main_message = await channel.send(embed=embed_main)
     
     if embed_reservas:
-        if embed_reservas_message:
-            await embed_reservas_message.edit(embed=embed_reservas)
+        if sesion.embed_reservas_message:
+            await sesion.embed_reservas_message.edit(embed=embed_reservas)
         else:
-            embed_reservas_message = await channel.send(embed=embed_reservas)
+            sesion.embed_reservas_message = await channel.send(embed=embed_reservas)
     
-    await insert_lista(embed_main_message, embed_reservas_message)
-    await actualizar_jugadores_db()
+    await guardar_lista_cerrada(sesion)
     await UpdateStatsPlayers(None)
+    if export_stats_on_close:
+        admin_channel = bot.get_channel(int(config['channel_admin']))
+        if admin_channel:
+            await enviar_exportacion(admin_channel)
     
-    lista_cerrada = True
+    sesiones.cerrar(sesion)
     await channel.send("⛔ La lista se ha cerrado. Ya no se pueden hacer cambios.")
 
 #################################################################################################
 
-async def insert_lista(embed_main_message, embed_reservas_message):
+async def guardar_lista_cerrada(sesion):
     """
-    Inserta una lista en la base de datos con estados 'si'/'no' y nombres sin escapar.
+    Guarda la lista cerrada y actualiza a sus jugadores en una unica transaccion, de modo que
+    cerrar una lista cuesta un solo commit sin importar el tamaño del historico.
     """
-    global miembros_lista, MAX_JUGADORES
+    miembros_objetos = sesion.miembros_objetos
 
-    embed_main_message_id = embed_main_message.id if embed_main_message else 0
-    embed_reservas_message_id = embed_reservas_message.id if embed_reservas_message else 0
+    embed_main_message_id = sesion.embed_main_message.id if sesion.embed_main_message else 0
+    embed_reservas_message_id = sesion.embed_reservas_message.id if sesion.embed_reservas_message else 0
     fecha_lista = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    normalized_miembros_lista = {k: "si" if v == "sí" else "no" if v == "no" else v for k, v in miembros_lista.items()}
-    datos_lista = json.dumps(normalized_miembros_lista, ensure_ascii=False)
-
-    query = '''
-    INSERT INTO Listas (FechaLista, DatosLista, NumJugadores, EmbedID, EmbedReservasID)
-    VALUES (?, ?, ?, ?, ?)
-    '''
-    sql_update(query, (fecha_lista, datos_lista, MAX_JUGADORES, embed_main_message_id, embed_reservas_message_id))
-    print(f"Lista guardada en la base de datos: {fecha_lista}")
+    estados_lista = sesion.miembros_lista.items()
+    # En la base de datos la lista se guarda por nombre, como se muestra
+    roster = [(sesion.nombre_en_lista(clave), estado, clave if isinstance(clave, int) else None)
+              for clave, estado in estados_lista]
+    datos_lista = json.dumps({nombre: estado for nombre, estado, _ in roster}, ensure_ascii=False)
+
+    # Los datos se preparan aqui, en el bucle de eventos, porque la transaccion corre en el hilo de la base de datos
+    fecha_partida = datetime.now().strftime("%d-%m-%Y")
+    jugadores = []
+    for jugador, estado in estados_lista:
+        member_obj = miembros_objetos.get(jugador)
+        if not es_jugador(member_obj):
+            log.info("El jugador %s no tiene el rol adecuado. No se procesará.", sesion.nombre_en_lista(jugador), extra={"sesion": sesion.clave})
+            continue
+        # Usar global_name si está disponible, de lo contrario usar name
+        apodo = member_obj.global_name if member_obj.global_name else member_obj.name
+        conectado = 1 if estado == "si" else 0
+        jugadores.append((member_obj.id, member_obj.name, apodo, conectado, 1 - conectado,
+                          fecha_partida if conectado else "Nunca ha jugado"))
 
-#################################################################################################
+    max_jugadores = sesion.max_jugadores
 
-async def actualizar_jugadores_db():
-    global miembros_lista, miembros_objetos
+    def guardar(con):
+        id_lista = insert_lista(con, fecha_lista, datos_lista, max_jugadores, embed_main_message_id, embed_reservas_message_id)
+        insert_lista_jugadores(con, filas_lista_jugadores(id_lista, roster, max_jugadores))
+        actualizar_jugadores_db(con, jugadores)
+        actualizar_historial(con, [(id_discord, id_lista, fecha_lista, 1 if estado == "si" else 0)
+                                   for _, estado, id_discord in roster if id_discord is not None])
 
-    # Obtener el total de partidas desde sqlite_sequence
-    query_total_partidas = "SELECT seq FROM sqlite_sequence WHERE name='Listas';"
-    total_partidas = sql_fetch(query_total_partidas)
-    total_partidas = total_partidas[0][0] if total_partidas else 0
+    await sql_transaccion(guardar, "cierre de lista")
+    log.info("Lista guardada en la base de datos: %s", fecha_lista, extra={"sesion": sesion.clave})
 
-    for jugador, estado in miembros_lista.items():
-        member_obj = miembros_objetos.get(jugador)
-        if not member_obj:
-            print(f"⚠️ El jugador `{jugador}` no tiene el rol adecuado. No se procesará.")
-            continue
+def insert_lista(con, fecha_lista, datos_lista, num_jugadores, embed_id, embed_reservas_id):
+    """
+    Inserta una lista en la base de datos con estados 'si'/'no' y nombres sin escapar.
+    """
+    query = '''
+    INSERT INTO Listas (FechaLista, DatosLista, NumJugadores, EmbedID, EmbedReservasID, FormatoDatos)
+    VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    return con.execute(query, (fecha_lista, datos_lista, num_jugadores, embed_id, embed_reservas_id, FORMATO_DATOS_ACTUAL)).lastrowid
 
-        user_discord = member_obj.name
-        # Usar global_name si está disponible, de lo contrario usar name
-        apodo = member_obj.global_name if member_obj.global_name else member_obj.name
+def actualizar_jugadores_db(con, jugadores):
+    """
+    Suma la partida a cada jugador de la lista con un unico INSERT ... ON CONFLICT DO UPDATE.
+    Los porcentajes no se guardan: los calcula la vista VistaJugadores al leer.
 
-        query = "SELECT * FROM Jugadores WHERE IdDiscord = ?;"
-        existing_player = sql_fetch(query, (member_obj.id,))
-
-        if existing_player:
-            partidas_inscrito = existing_player[0][3] + 1
-            partidas_conectado = existing_player[0][4] + 1 if estado == "si" else existing_player[0][4]
-            partidas_desconectado = existing_player[0][5] + 1 if estado == "no" else existing_player[0][5]
-            ultima_partida = datetime.now().strftime("%d-%m-%Y") if estado == "si" else (existing_player[0][8] if existing_player[0][8] else "Nunca ha jugado")
-            query_update = '''
-                UPDATE Jugadores
-                SET PartidasInscrito = ?,
-                    PartidasConectado = ?,
-                    PartidasDesconectado = ?,
-                    UltimaPartida = ?
-                WHERE IdDiscord = ?;
-            '''
-            sql_update(query_update, (partidas_inscrito, partidas_conectado, partidas_desconectado, ultima_partida, member_obj.id))
-        else:
-            partidas_inscrito = 1
-            partidas_conectado = 1 if estado == "si" else 0
-            partidas_desconectado = 1 if estado == "no" else 0
-            ultima_partida = datetime.now().strftime("%d-%m-%Y") if estado == "si" else "Nunca ha jugado"
-            query_update = '''
-                INSERT INTO Jugadores (IdDiscord, UserDiscord, Apodo, PartidasInscrito, PartidasConectado, PartidasDesconectado, UltimaPartida)
-                VALUES (?, ?, ?, ?, ?, ?, ?);
-            '''
-            sql_update(query_update, (member_obj.id, user_discord, apodo, partidas_inscrito, partidas_conectado, partidas_desconectado, ultima_partida))
-
-    # Actualizar porcentajes
-    query_all_players = "SELECT IdDiscord, PartidasInscrito FROM Jugadores;"
-    all_players = sql_fetch(query_all_players)
-    for player_id, partidas_inscrito in all_players:
-        query_desconectado = "SELECT PartidasDesconectado FROM Jugadores WHERE IdDiscord = ?;"
-        desconectados = sql_fetch(query_desconectado, (player_id,))
-        partidas_desconectado = desconectados[0][0] if desconectados else 0
-        porcentaje_inscrito = round((partidas_inscrito / total_partidas) * 100, 2) if total_partidas > 0 else 0
-        porcentaje_ausencias = round((partidas_desconectado / partidas_inscrito) * 100, 2) if partidas_inscrito > 0 else 0
-        query_update_percentage = '''
-            UPDATE Jugadores
-            SET PorcentajeInscrito = ?,
-                PorcentajeAusencias = ?
-            WHERE IdDiscord = ?;
-        '''
-        sql_update(query_update_percentage, (porcentaje_inscrito, porcentaje_ausencias, player_id))
-
-    print("✅ Los jugadores han sido actualizados en la base de datos.")
+    Args:
+        jugadores (list): Tuplas (IdDiscord, UserDiscord, Apodo, conectado, desconectado, UltimaPartida).
+    """
+    query = '''
+        INSERT INTO Jugadores (IdDiscord, UserDiscord, Apodo, PartidasInscrito, PartidasConectado, PartidasDesconectado, UltimaPartida)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT(IdDiscord) DO UPDATE SET
+            PartidasInscrito = PartidasInscrito + 1,
+            PartidasConectado = PartidasConectado + excluded.PartidasConectado,
+            PartidasDesconectado = PartidasDesconectado + excluded.PartidasDesconectado,
+            UltimaPartida = CASE WHEN excluded.PartidasConectado = 1 THEN excluded.UltimaPartida
+                                 ELSE COALESCE(UltimaPartida, excluded.UltimaPartida) END;
+    '''
+    con.executemany(query, jugadores)
 
 #################################################################################################
 
+async def listas_de_jugador(id_discord, limite=None):
+    """
+    Devuelve [(idLista, FechaLista, Posicion, Reserva, Estado)] de las listas en las que ha estado
+    el jugador, de la mas reciente a la mas antigua. Usa el indice de ListaJugadores por IdDiscord.
+    """
+    query = '''
+        SELECT lj.idLista, l.FechaLista, lj.Posicion, lj.Reserva, lj.Estado
+        FROM ListaJugadores lj JOIN Listas l ON l.idLista = lj.idLista
+        WHERE lj.IdDiscord = ?
+        ORDER BY lj.idLista DESC
+        LIMIT ?;
+    '''
+    return await sql_fetch(query, (id_discord, -1 if limite is None else limite))
+
+async def leer_configuracion(clave):
+    resultado = await sql_fetch("SELECT Valor FROM Configuracion WHERE Clave = ?;", (clave,))
+    return resultado[0][0] if resultado else None
+
+async def guardar_configuracion(clave, valor):
+    await sql_update("INSERT INTO Configuracion (Clave, Valor) VALUES (?, ?) ON CONFLICT(Clave) DO UPDATE SET Valor = excluded.Valor;", (clave, str(valor)))
+
+def empaquetar_paginas(lineas, limite=2000):
+    """Agrupa lineas en mensajes de como mucho `limite` caracteres sin partir ninguna linea."""
+    paginas, actual = [], ""
+    for linea in lineas:
+        linea = linea[:limite - 1]
+        if actual and len(actual) + len(linea) + 1 > limite:
+            paginas.append(actual)
+            actual = ""
+        actual += linea + "\n"
+    if actual:
+        paginas.append(actual)
+    return paginas
+
+async def obtener_hilo_stats(channel):
+    """
+    Devuelve el hilo de estadisticas guardado en Configuracion, o lo busca por nombre o lo crea.
+    """
+    thread = None
+    thread_id = await leer_configuracion("HiloStats")
+    if thread_id:
+        thread = channel.guild.get_thread(int(thread_id))
+        if thread is None:
+            try:
+                thread = await bot.fetch_channel(int(thread_id))  # Los hilos archivados no estan en cache
+            except (discord.NotFound, discord.Forbidden):
+                thread = None
+    if thread is None:
+        thread = next((t for t in channel.threads if t.name == THREAD_STATS_NAME), None)
+    if thread is None:
+        # Crear un nuevo hilo público visible para los miembros del canal
+        thread = await channel.create_thread(name=THREAD_STATS_NAME, type=discord.ChannelType.public_thread)
+    if thread.archived:
+        await thread.edit(archived=False)
+    if str(thread.id) != thread_id:
+        # Hilo nuevo: los mensajes guardados eran de otro hilo
+        await guardar_configuracion("HiloStats", thread.id)
+        await sql_update("DELETE FROM MensajesStats;")
+    return thread
+
 @bot.command()
 async def UpdateStatsPlayers(ctx):
+    """
+    Actualiza el hilo de estadisticas. Las paginas se llenan hasta el limite de 2000 caracteres
+    y solo se editan las que han cambiado; las que no, no cuestan ninguna llamada a Discord.
+    """
     global THREAD_STATS_NAME
 
     query_total_partidas = "SELECT seq FROM sqlite_sequence WHERE name='Listas';"
-    total_partidas = sql_fetch(query_total_partidas)
+    total_partidas = await sql_fetch(query_total_partidas)
     total_partidas = total_partidas[0][0] if total_partidas else 0
-    query = "SELECT Apodo, PartidasInscrito, PartidasConectado, PartidasDesconectado, PorcentajeInscrito, PorcentajeAusencias, UltimaPartida FROM Jugadores"
-    jugadores = sql_fetch(query)
+    query = "SELECT Apodo, PartidasInscrito, PartidasConectado, PartidasDesconectado, PorcentajeInscrito, PorcentajeAusencias, UltimaPartida FROM VistaJugadores ORDER BY IdDiscord"
+    jugadores = await sql_fetch(query)
     
     channel = bot.get_channel(int(config['channel_admin']))
     if not channel:
-        print("⚠️ No se encontró el canal especificado.")
+        log.warning("No se encontró el canal de administración.")
         return
     
     if not jugadores:
         await channel.send("No hay jugadores registrados en la base de datos.")
-    else:
-        # Aumentamos el ancho de la columna "Apodo" para que no desplace las demás columnas
-        widths = [20, 18, 18, 20, 10, 10, 19]  # Se amplió el primer valor de 15 a 20
+        return
 
-        def get_color_from_percentage(percentage, is_inscription):
-            if is_inscription:
-                return "🔵" if percentage >= 90 else "🟢" if percentage >= 60 else "🟡" if percentage >= 40 else "🟠" if percentage >= 20 else "🔴"
-            else:
-                return "🔵" if percentage <= 10 else "🟢" if percentage <= 39 else "🟡" if percentage <= 59 else "🟠" if percentage <= 79 else "🔴"
-
-        # Buscar si ya existe un hilo con el nombre
-        thread = None
-        for t in channel.threads:
-            if t.name == THREAD_STATS_NAME:
-                thread = t
-                break
-        
-        # Si existe, eliminarlo
-        if thread:
-            await thread.delete()
-        
-        # Crear un nuevo hilo público visible para los miembros del canal
-        thread = await channel.create_thread(name=THREAD_STATS_NAME, type=discord.ChannelType.public_thread)
+    # Aumentamos el ancho de la columna "Apodo" para que no desplace las demás columnas
+    widths = [20, 18, 18, 20, 10, 10, 19]  # Se amplió el primer valor de 15 a 20
+
+    def get_color_from_percentage(percentage, is_inscription):
+        if is_inscription:
+            return "🔵" if percentage >= 90 else "🟢" if percentage >= 60 else "🟡" if percentage >= 40 else "🟠" if percentage >= 20 else "🔴"
+        else:
+            return "🔵" if percentage <= 10 else "🟢" if percentage <= 39 else "🟡" if percentage <= 59 else "🟠" if percentage <= 79 else "🔴"
+
+    # La cabecera va una sola vez, al principio de la primera pagina
+    lineas = [
+        f"📋 **Partidas totales jugadas: {total_partidas}**\n",
+        f"{'Apodo':<{widths[0]}} | {'Part. Inscritas':>{widths[1]}} | {'Part. Conectado':>{widths[2]}} | {'Part. Desconectado':>{widths[3]}} | {'% Inscr.':>{widths[4]}} | {'% Aus.':>{widths[5]}} | {'Última Partida':>{widths[6]}}",
+        "─" * (sum(widths) + 6*3),
+    ]
+    for user in jugadores:
+        apodo, inscritos, conectados, desconectados, porcentaje_inscrito, porcentaje_ausencias, ultima_partida = user
+        # Manejar caso donde apodo es None
+        display_name = apodo if apodo is not None else "Sin apodo"
+        color_inscripcion = get_color_from_percentage(porcentaje_inscrito, is_inscription=True)
+        color_ausencias = get_color_from_percentage(porcentaje_ausencias, is_inscription=False)
+
+        lineas.append(f"{display_name:<{widths[0]}} | {inscritos:>{widths[1]}} | {conectados:>{widths[2]}} | "
+                      f"{desconectados:>{widths[3]}} | {color_inscripcion} {porcentaje_inscrito:>{widths[4]}.2f}% | "
+                      f"{color_ausencias} {porcentaje_ausencias:>{widths[5]}.2f}% | "
+                      f"{ultima_partida if ultima_partida else 'No disponible':>{widths[6]}}")
+    paginas = empaquetar_paginas(lineas)
+
+    thread = await obtener_hilo_stats(channel)
+    guardadas = {pagina: (mensaje_id, firma) for pagina, mensaje_id, firma in await sql_fetch("SELECT Pagina, MensajeID, Firma FROM MensajesStats;")}
+
+    nuevas = []
+    for numero, contenido in enumerate(paginas):
+        firma = hashlib.sha1(contenido.encode("utf-8")).hexdigest()
+        mensaje_id, firma_guardada = guardadas.pop(numero, (None, None))
+        if firma == firma_guardada:
+            continue  # Pagina sin cambios: ninguna llamada a Discord
+        editado = False
+        if mensaje_id is not None:
+            try:
+                await thread.get_partial_message(mensaje_id).edit(content=contenido)
+                metricas.contar("ediciones_total", tipo="stats")
+                editado = True
+            except discord.NotFound:
+                pass  # Alguien lo ha borrado: se envía de nuevo
+        if not editado:
+            mensaje_id = (await thread.send(contenido)).id
+        nuevas.append((numero, mensaje_id, firma))
+
+    # Paginas que sobran porque ahora el texto ocupa menos
+    for mensaje_id, _ in guardadas.values():
+        try:
+            await thread.get_partial_message(mensaje_id).delete()
+        except discord.NotFound:
+            pass
 
-        for i in range(0, len(jugadores), 5):
-            group = jugadores[i:i+5]
-            
-            message = f"📋 **Partidas totales jugadas: {total_partidas}**\n\n"
-            message += f"{'Apodo':<{widths[0]}} | {'Part. Inscritas':>{widths[1]}} | {'Part. Conectado':>{widths[2]}} | {'Part. Desconectado':>{widths[3]}} | {'% Inscr.':>{widths[4]}} | {'% Aus.':>{widths[5]}} | {'Última Partida':>{widths[6]}}\n"
-            message += "─" * (sum(widths) + 6*3) + "\n"
-
-            for user in group:
-                apodo, inscritos, conectados, desconectados, porcentaje_inscrito, porcentaje_ausencias, ultima_partida = user
-                # Manejar caso donde apodo es None
-                display_name = apodo if apodo is not None else "Sin apodo"
-                color_inscripcion = get_color_from_percentage(porcentaje_inscrito, is_inscription=True)
-                color_ausencias = get_color_from_percentage(porcentaje_ausencias, is_inscription=False)
-
-                line = (f"{display_name:<{widths[0]}} | {inscritos:>{widths[1]}} | {conectados:>{widths[2]}} | "
-                        f"{desconectados:>{widths[3]}} | {color_inscripcion} {porcentaje_inscrito:>{widths[4]}.2f}% | "
-                        f"{color_ausencias} {porcentaje_ausencias:>{widths[5]}.2f}% | "
-                        f"{ultima_partida if ultima_partida else 'No disponible':>{widths[6]}}")
-
-                message += line + "\n"
-            
-            await thread.send(message)
-            await asyncio.sleep(1)
+    def guardar(con):
+        con.executemany("INSERT OR REPLACE INTO MensajesStats (Pagina, MensajeID, Firma) VALUES (?, ?, ?);", nuevas)
+        con.execute("DELETE FROM MensajesStats WHERE Pagina >= ?;", (len(paginas),))
+
+    await sql_transaccion(guardar, "paginas de estadisticas")
 
 #################################################################################################
 
+class OpcionesExportacion(commands.FlagConverter, delimiter=' ', prefix='-'):
+    formato: str = "csv"  # csv o txt (ancho fijo)
+    min_listas: int = 0  # Minimo de listas en las que se ha inscrito
+    ausencias: float = None  # Solo jugadores con un % de ausencias igual o superior
+    orden: str = "apodo"  # apodo, inscritas, ausencias o ultima
+
+ORDEN_EXPORTACION = {
+    "apodo": "Apodo COLLATE NOCASE",
+    "inscritas": "PartidasInscrito DESC",
+    "ausencias": "PorcentajeAusencias DESC",
+    "ultima": "UltimaPartida DESC",
+}
+COLUMNAS_JUGADORES = ["IdDiscord", "UserDiscord", "Apodo", "PartidasInscrito", "PartidasConectado", "PartidasDesconectado",
+                      "PorcentajeInscrito", "PorcentajeAusencias", "UltimaPartida"]
+COLUMNAS_ASISTENCIA = ["idLista", "FechaLista", "IdDiscord", "Nombre", "Posicion", "Reserva", "Estado"]
+ANCHOS_JUGADORES = [20, 20, 20, 16, 17, 20, 18, 19, 15]
+ANCHOS_ASISTENCIA = [8, 19, 20, 20, 8, 7, 6]
+
+def escribir_exportacion(cursor, columnas, formato, anchos):
+    """
+    Vuelca un cursor a un fichero temporal fila a fila, sin cargar el resultado en memoria.
+    Pasa a disco cuando supera 1 MB.
+    """
+    fichero = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+b")
+    texto = io.TextIOWrapper(fichero, encoding="utf-8-sig", newline="")
+    if formato == "csv":
+        escritor = csv.writer(texto)
+        escritor.writerow(columnas)
+        escritor.writerows(cursor)
+    else:
+        def linea(valores):
+            return " ".join(f"{'' if valor is None else valor!s:<{ancho}.{ancho}}" for valor, ancho in zip(valores, anchos)).rstrip() + "\n"
+        texto.write(linea(columnas))
+        for fila in cursor:
+            texto.write(linea(fila))
+    texto.flush()
+    texto.detach()
+    fichero.seek(0)
+    return fichero
+
+async def enviar_exportacion(destino, formato="csv", min_listas=0, ausencias=None, orden="apodo"):
+    """
+    Exporta los jugadores y su asistencia por lista y los envia como dos adjuntos en un unico mensaje.
+    Los filtros y el orden se resuelven en SQL.
+    """
+    formato = formato.lower()
+    if formato not in ("csv", "txt"):
+        await destino.send("⚠️ El formato debe ser `csv` o `txt`.")
+        return
+    orden = ORDEN_EXPORTACION.get(orden.lower())
+    if orden is None:
+        await destino.send(f"⚠️ El orden debe ser uno de: {', '.join(ORDEN_EXPORTACION)}.")
+        return
+
+    condiciones, parametros = ["PartidasInscrito >= ?"], [min_listas]
+    if ausencias is not None:
+        condiciones.append("PorcentajeAusencias >= ?")
+        parametros.append(ausencias)
+    where = " AND ".join(condiciones)
+    query_jugadores = f"SELECT {', '.join(COLUMNAS_JUGADORES)} FROM VistaJugadores WHERE {where} ORDER BY {orden};"
+    query_asistencia = f'''
+        SELECT lj.idLista, l.FechaLista, lj.IdDiscord, lj.Nombre, lj.Posicion, lj.Reserva, lj.Estado
+        FROM ListaJugadores lj JOIN Listas l ON l.idLista = lj.idLista
+        WHERE lj.IdDiscord IN (SELECT IdDiscord FROM VistaJugadores WHERE {where})
+        ORDER BY lj.idLista, lj.Posicion;
+    '''
+
+    def exportar(con):
+        return (
+            escribir_exportacion(con.execute(query_jugadores, parametros), COLUMNAS_JUGADORES, formato, ANCHOS_JUGADORES),
+            escribir_exportacion(con.execute(query_asistencia, parametros), COLUMNAS_ASISTENCIA, formato, ANCHOS_ASISTENCIA),
+        )
+
+    try:
+        jugadores, asistencia = await db.ejecutar(exportar, "exportacion de estadisticas")
+    except sqlite3.Error as error:
+        log.error("Error al exportar las estadísticas: %s", error)
+        await destino.send("⚠️ No se pudieron exportar las estadísticas.")
+        return
+
+    fecha = datetime.now().strftime("%Y%m%d_%H%M")
+    with jugadores, asistencia:
+        await destino.send(
+            content="📊 Estadísticas de jugadores",
+            files=[discord.File(jugadores, filename=f"jugadores_{fecha}.{formato}"),
+                   discord.File(asistencia, filename=f"asistencia_{fecha}.{formato}")]
+        )
+
 @bot.command()
-async def SetMP(ctx):
+async def ExportStats(ctx, *, opciones: OpcionesExportacion):
+    """
+    Exporta las estadisticas como fichero adjunto.
+    Opciones: -formato csv|txt -min_listas N -ausencias PORCENTAJE -orden apodo|inscritas|ausencias|ultima
+    """
+    await enviar_exportacion(ctx, opciones.formato, opciones.min_listas, opciones.ausencias, opciones.orden)
+
+#################################################################################################
+
+@bot.tree.command(name="setmp", description="Cambia el número máximo de jugadores de las próximas listas")
+@app_commands.describe(valor="Número máximo de jugadores (entre 1 y 50)")
+@app_commands.check(es_admin_en_canal_eventos)
+async def SetMP(interaction: discord.Interaction, valor: app_commands.Range[int, 1, 50]):
+    global MAX_JUGADORES, MAX_JUGADORES_LISTAS
+
+    if sesiones.abiertas():  # Si hay alguna lista abierta
+        await interaction.response.send_message("No se puede modificar este parámetro hasta que todas las listas estén cerradas.", ephemeral=True)
+        return
 
-    if not lista_cerrada:  # Si la lista está abierta
-        await ctx.send("No se puede modificar este parámetro hasta que la lista esté cerrada.")
-        return  # Salir de la función sin hacer nada
+    def guardar_en_env():
+        # Cargar el archivo .env
+        dotenv_file = dotenv.find_dotenv()
+        dotenv.load_dotenv(dotenv_file)
 
-    await ctx.send("Introduce el número máximo de jugadores (entre 1 y 50):")
+        # Actualizar el valor en el archivo .env
+        os.environ["MAX_PLAYERS"] = str(valor)
+        dotenv.set_key(dotenv_file, "MAX_PLAYERS", os.environ["MAX_PLAYERS"])
+
+    # Leer y reescribir el .env es E/S de disco: se hace en un hilo para no parar el bucle de eventos
+    await asyncio.to_thread(guardar_en_env)
+
+    # Actualizar las variables globales directamente
+    MAX_JUGADORES = valor
+    MAX_JUGADORES_LISTAS = MAX_JUGADORES * 2
     
-    while True:
+    log.info("MAX_JUGADORES actualizado a %s (MAX_JUGADORES_LISTAS: %s)", MAX_JUGADORES, MAX_JUGADORES_LISTAS, extra={"miembro": interaction.user.id})
+
+    # Confirmación
+    await interaction.response.send_message(f"✅ Se ha actualizado MAX_PLAYERS a {valor}.", ephemeral=True)
+
+#################################################################################################
+
+@bot.command()
+async def DBStats(ctx):
+    """
+    Muestra cuantas veces se ha ejecutado cada consulta y su tiempo medio y maximo, y los aciertos
+    de la cache de listas cerradas.
+    """
+    estadisticas = db.estadisticas()
+    if not estadisticas:
+        await ctx.send("📪 Todavía no se ha ejecutado ninguna consulta.")
+        return
+
+    consultas_cache = cache_rosters.aciertos + cache_rosters.fallos
+    lineas = [f"Cache de listas: {cache_rosters.aciertos} aciertos, {cache_rosters.fallos} fallos"
+              f" ({cache_rosters.aciertos * 100 / consultas_cache if consultas_cache else 0:.0f}%),"
+              f" {len(cache_rosters.rosters)}/{cache_rosters.capacidad} listas",
+              f"{'Consulta':<60} | {'Nº':>5} | {'Media ms':>9} | {'Max ms':>9}"]
+    for consulta, ejecuciones, media_ms, max_ms in estadisticas:
+        consulta = consulta if len(consulta) <= 60 else consulta[:57] + "..."
+        lineas.append(f"{consulta:<60} | {ejecuciones:>5} | {media_ms:>9.2f} | {max_ms:>9.2f}")
+
+    mensaje = ""
+    for linea in lineas:
+        if len(mensaje) + len(linea) + 9 > 2000:  # 2000 es el limite de Discord, contando el bloque de codigo
+            break
+        mensaje += linea + "\n"
+    await ctx.send(f"```\n{mensaje}```")
+
+@bot.command()
+async def DMStatus(ctx):
+    """
+    Muestra el estado de los mensajes privados de la lista actual y su latencia desde que se encolaron.
+    Fuera de un canal de listas muestra la ultima lista de cada canal del servidor.
+    """
+    sesion = sesiones.de_contexto(ctx)
+    if sesion is not None:
+        claves = [sesion.clave]
+    else:
+        claves = [clave for clave in despachador_mensajes.entregas if ctx.guild and clave[0] == ctx.guild.id]
+    cantidades, latencias = despachador_mensajes.resumen(claves)
+    if not cantidades:
+        await ctx.send("📪 No se ha enviado ningún mensaje privado en esta lista.")
+        return
+
+    mensaje = "📨 **Mensajes privados:** " + " | ".join(f"{estado}: {cantidad}" for estado, cantidad in sorted(cantidades.items()))
+    if latencias:
+        p50 = latencias[len(latencias) // 2]
+        p95 = latencias[min(len(latencias) - 1, int(len(latencias) * 0.95))]
+        mensaje += f"\n⏱️ Latencia p50: {p50:.1f}s | p95: {p95:.1f}s | máx: {latencias[-1]:.1f}s"
+    mensaje += f"\n⚙️ Envíos simultáneos permitidos: {despachador_mensajes.limite}/{despachador_mensajes.concurrencia_max}"
+    await ctx.send(mensaje)
+
+@bot.command()
+async def Metrics(ctx):
+    """
+    Resumen de las metricas: contadores y, de cada histograma, numero de muestras, media y p95 aproximado.
+    """
+    if not metricas.activas:
+        await ctx.send("📪 Las métricas están desactivadas. Actívalas con `METRICS='true'` en el .env.")
+        return
+
+    def nombre_con_etiquetas(nombre, etiquetas):
+        return nombre + "".join(f" {valor}" for _, valor in etiquetas)
+
+    with metricas.lock:
+        contadores = sorted(metricas.contadores.items())
+        histogramas = sorted((clave, list(valores)) for clave, valores in metricas.histogramas.items())
+
+    lineas = [f"{'Contador':<45} | {'Valor':>10}"]
+    for (nombre, etiquetas), valor in contadores:
+        lineas.append(f"{nombre_con_etiquetas(nombre, etiquetas)[:45]:<45} | {valor:>10.4g}")
+    lineas.append("")
+    lineas.append(f"{'Histograma':<45} | {'Nº':>7} | {'Media ms':>9} | {'p95 ms':>8}")
+    for (nombre, etiquetas), histograma in histogramas:
+        muestras = sum(histograma[:-1])
+        media_ms = histograma[-1] / muestras * 1000 if muestras else 0
+        lineas.append(f"{nombre_con_etiquetas(nombre, etiquetas)[:45]:<45} | {muestras:>7} | {media_ms:>9.2f} | {metricas.percentil(histograma, 0.95) * 1000:>8.0f}")
+
+    for pagina in empaquetar_paginas(lineas, limite=1990):
+        await ctx.send(f"```\n{pagina}```")
+
+#################################################################################################
+
+class LimpiadorCanal:
+    """
+    Borra de un canal de eventos los mensajes que no son embeds.
+
+    Recuerda el id del ultimo mensaje revisado para pedir a Discord solo el historial nuevo, borra
+    en bloque (delete_messages) los mensajes de menos de 14 dias y se despierta antes de tiempo
+    cuando el canal se llena de mensajes sin embed.
+    """
+
+    INTERVALO = 101  # Segundos maximos entre limpiezas
+    UMBRAL_MENSAJES = 10  # Mensajes sin embed que provocan una limpieza inmediata
+    LIMITE_PRIMERA_REVISION = 50  # Mensajes que se revisan la primera vez, cuando no hay marca
+    MAX_EDAD_BLOQUE = 14 * 24 * 3600 - 60  # Discord no permite borrar en bloque mensajes de 14 dias o mas
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.ultimo_revisado = None
+        self.mensajes_nuevos = 0
+        self.avisar = asyncio.Event()
+
+    def registrar(self, message):
+        self.mensajes_nuevos += 1
+        if not message.embeds and self.mensajes_nuevos >= self.UMBRAL_MENSAJES:
+            self.avisar.set()
+
+    async def esperar(self):
         try:
-            msg = await bot.wait_for('message', check=lambda m: m.author == ctx.author, timeout=30)
-            if msg.content.isdigit():
-                new_value = int(msg.content)
-                if 1 <= new_value <= 50:
-                    global MAX_JUGADORES, MAX_JUGADORES_LISTAS
-                    
-                    # Cargar el archivo .env
-                    dotenv_file = dotenv.find_dotenv()
-                    dotenv.load_dotenv(dotenv_file)
-
-                    # Actualizar el valor en el archivo .env
-                    os.environ["MAX_PLAYERS"] = str(new_value)
-                    dotenv.set_key(dotenv_file, "MAX_PLAYERS", os.environ["MAX_PLAYERS"])
-
-                    # Actualizar las variables globales directamente
-                    MAX_JUGADORES = new_value
-                    MAX_JUGADORES_LISTAS = MAX_JUGADORES * 2
-                    
-                    # Imprimir para verificar
-                    print(f"MAX_JUGADORES actualizado a: {MAX_JUGADORES}")
-                    print(f"MAX_JUGADORES_LISTAS calculado a: {MAX_JUGADORES_LISTAS}")
-
-                    # Confirmación
-                    await ctx.send(f"✅ Se ha actualizado MAX_PLAYERS a {new_value}.")
-                    break
-                else:
-                    await ctx.send("⚠️ Ingresa un número válido entre 1 y 50.")
-            else:
-                await ctx.send("⚠️ Ingresa un número válido entre 1 y 50.")
+            await asyncio.wait_for(self.avisar.wait(), timeout=self.INTERVALO)
         except asyncio.TimeoutError:
-            await ctx.send("⏳ Tiempo de espera agotado. Operación cancelada.")
+            pass
+        self.avisar.clear()
+
+    async def limpiar(self, channel):
+        # Sin mensajes nuevos desde la ultima revision no hace falta pedir el historial
+        if self.ultimo_revisado is not None and self.mensajes_nuevos == 0:
             return
+        self.mensajes_nuevos = 0
 
-#################################################################################################
+        if self.ultimo_revisado is None:
+            historial = channel.history(limit=self.LIMITE_PRIMERA_REVISION)
+        else:
+            historial = channel.history(limit=None, after=discord.Object(id=self.ultimo_revisado))
+
+        limite_bloque = discord.utils.utcnow().timestamp() - self.MAX_EDAD_BLOQUE
+        recientes, antiguos = [], []
+        async for msg in historial:
+            self.ultimo_revisado = max(self.ultimo_revisado or 0, msg.id)
+            if msg.embeds:
+                continue
+            (recientes if msg.created_at.timestamp() > limite_bloque else antiguos).append(msg)
+
+        # delete_messages admite hasta 100 mensajes por llamada
+        for i in range(0, len(recientes), 100):
+            try:
+                await channel.delete_messages(recientes[i:i + 100])
+                metricas.contar("mensajes_borrados_total", len(recientes[i:i + 100]), modo="bloque")
+            except discord.NotFound:
+                # Alguno ya no existe (por ejemplo, si se eliminó previamente)
+                continue
+        for msg in antiguos:
+            try:
+                await msg.delete()
+                metricas.contar("mensajes_borrados_total", modo="individual")
+            except discord.NotFound:
+                continue
 
-async def borrar_mensajes_sin_embed():
+limpiadores_canal = {channel_id: LimpiadorCanal(channel_id) for channel_id in CANALES_EVENTOS}
+
+async def borrar_mensajes_sin_embed(channel_id):
+    limpiador = limpiadores_canal[channel_id]
     while True:
-        await asyncio.sleep(101)  # Esperar los segundos entre limpiezas
+        await limpiador.esperar()
 
         # Obtener el canal específico usando el ID desde la configuración
-        channel = bot.get_channel(int(config['channel_default']))
+        channel = bot.get_channel(channel_id)
 
         if channel:
-            # Obtener los últimos X mensajes del canal
-            async for msg in channel.history(limit=50):
-                # Verificar si el mensaje no tiene un embed
-                if not msg.embeds:  # Si el mensaje no tiene un embed
-                    try:
-                        # Borrar el mensaje
-                        await msg.delete()
-                        #print(f"Mensaje borrado: {msg.content}")
-                        # Esperar 5 segundos antes de borrar el siguiente mensaje
-                        await asyncio.sleep(2)
-                    except discord.errors.NotFound:
-                        # El mensaje ya no existe (por ejemplo, si se eliminó previamente)
-                        continue
+            try:
+                await limpiador.limpiar(channel)
+            except discord.HTTPException as error:
+                log.error("Error al limpiar el canal %s: %s", channel_id, error)
         else:
-            print("Canal no encontrado o el bot no tiene acceso a él.")
+            log.warning("Canal %s no encontrado o el bot no tiene acceso a él.", channel_id)
 
 #################################################################################################
 
 @bot.event
+@medir_evento
 async def on_voice_state_update(member, before, after):
-    global embed_main_message, embed_reservas_message, miembros_lista, adding_players, adding_lock, ultima_actualizacion_embed, embed_update_lock
-    if lista_cerrada:
-        return
-
-    # Caso 1: Añadir automáticamente desde el canal de reservas
-    if member.display_name not in miembros_lista and after.channel and after.channel.id == VOICE_CHR_ID:
-        async with adding_lock:
-            if member.display_name not in adding_players:
-                adding_players.add(member.display_name)
-                modo = "automatico"
-                # Obtener el canal predeterminado
-                channel = bot.get_channel(int(config['channel_default']))
-                print(f"Añadiendo automáticamente a {member.display_name} desde canal de reservas")  # Depuración
-                await add_players(channel, member, modo)
-                adding_players.remove(member.display_name)
-
-    # Caso 2: Actualizar estado de miembros en la lista
-    if member.display_name in miembros_lista:
-        if before.channel is None and after.channel is not None:
-            miembros_lista[member.display_name] = "si"
-            print(f"{member.display_name} se ha conectado. Estado actualizado a 'si'.")
-        elif before.channel is not None and after.channel is None:
-            miembros_lista[member.display_name] = "no"
-            print(f"{member.display_name} se ha desconectado. Estado actualizado a 'no'.")
-
-        # Limitar la actualización del embed a una vez cada 2 segundos
-        if embed_main_message or embed_reservas_message:
-            async with embed_update_lock:
-                tiempo_actual = time.time()
-                if tiempo_actual - ultima_actualizacion_embed >= 2:  # 2 segundos de intervalo mínimo
-                    channel = bot.get_channel(int(config['channel_default']))
-                    print(f"Actualizando embeds para {member.display_name}")  # Depuración
-                    await actualizar_embeds(channel)
-                    ultima_actualizacion_embed = tiempo_actual
+    guild_id = member.guild.id
+    # El canal anterior se toma del indice, que tambien refleja lo corregido al resincronizar
+    canal_anterior = presencia.canal_de(guild_id, member.id)
+    presencia.actualizar(member, after)
+
+    # Caso 1: Añadir automáticamente desde el canal de reservas a las listas abiertas del guild
+    if presencia.en_canal(guild_id, member.id, VOICE_CHR_ID):
+        for sesion in sesiones.abiertas(guild_id):
+            if member.id not in sesion.miembros_lista:
+                await añadir_jugador_automatico(sesion, member)
+
+    # Caso 2: Actualizar estado del miembro solo en las listas en las que aparece
+    conectado = presencia.conectado(guild_id, member.id)
+    if (canal_anterior is not None) == conectado:
+        return
 
-#################################################################################################
+    for sesion in list(sesiones.de_miembro(guild_id, member.id)):
+        if not sesion.admite_cambios or member.id not in sesion.miembros_lista:
+            continue
+        sesion.enlazar(member)
+        sesion.cambiar_estado(member.id, conectado)
+        if conectado:
+            despachador_mensajes.cancelar(sesion, member.id, "ya está conectado")
+            log.info("%s se ha conectado. Estado actualizado a 'si'.", member.display_name, extra={"sesion": sesion.clave, "miembro": member.id})
+        else:
+            log.info("%s se ha desconectado. Estado actualizado a 'no'.", member.display_name, extra={"sesion": sesion.clave, "miembro": member.id})
 
-async def comprobar_conectados_periodicamente():
-    global VOICE_CHR_ID
+        # Las actualizaciones se agrupan: como mucho una edición cada 2 segundos y siempre la última
+        if sesion.actualizador.iniciado:
+            sesion.actualizador.solicitar()
 
-    while True:
-        await asyncio.sleep(60)  # Espera 60 segundos
+#################################################################################################
+
+def reconciliar_sesion(sesion, guild):
+    """
+    Pone el estado de cada jugador de la sesion de acuerdo con el indice de presencia en una
+    sola pasada. Devuelve True si ha cambiado alguno.
+    """
+    miembros_lista = sesion.miembros_lista
+    # Los nombres que no se pudieron identificar solo se pueden comprobar por display_name
+    connected_members = presencia.miembros_por_nombre(guild) if any(isinstance(k, str) for k in miembros_lista) else {}
+
+    # Actualizar solo los miembros cuyo estado haya cambiado
+    cambios = False
+    for miembro in list(miembros_lista):
+        conectado = presencia.conectado(guild.id, miembro) if isinstance(miembro, int) else miembro in connected_members
+        if sesion.cambiar_estado(miembro, conectado):
+            cambios = True
+    return cambios
+
+class ResincronizadorPresencia:
+    """
+    Comprueba que el indice de presencia y las listas no se hayan desviado del estado real de voz.
+    Solo trabaja cuando el gateway se reanuda o reconecta, que es cuando se pueden perder eventos.
 
-        if lista_cerrada:
-            continue  # Saltar iteración si la lista está cerrada
+    Hay una tarea por shard y cada una solo recorre los guilds de su shard, cediendo el bucle entre
+    un guild y el siguiente, asi el corte de un shard no retrasa los eventos de los demas.
+    """
 
-        # Obtener miembros conectados
-        connected_members = {member.display_name for guild in bot.guilds for channel in guild.voice_channels for member in channel.members}
-        #print(f"Miembros conectados actualizados: {connected_members}")  # Mostrar miembros conectados actualizados
+    def __init__(self):
+        self.pendientes = {}  # shard -> asyncio.Event
+        self.tareas = {}  # shard -> tarea
+
+    def solicitar(self, shard_id=None):
+        """Pide resincronizar un shard, o todos si no se indica."""
+        shards = [shard_id] if shard_id is not None else sorted({guild.shard_id for guild in bot.guilds})
+        for shard in shards:
+            pendiente = self.pendientes.get(shard)
+            if pendiente is None:
+                pendiente = self.pendientes[shard] = asyncio.Event()
+                self.tareas[shard] = asyncio.create_task(self._bucle(shard, pendiente))
+            pendiente.set()
+
+    async def _bucle(self, shard_id, pendiente):
+        while True:
+            await pendiente.wait()
+            pendiente.clear()
+            log.info("Resincronizando la presencia del shard %s", shard_id)
 
-        # Actualizar la lista de miembros conectados
-        for miembro in miembros_lista:
-            if miembro in connected_members:
-                miembros_lista[miembro] = "si"
-            else:
-                miembros_lista[miembro] = "no"
-            #print(miembros_lista)  # Se imprime cada vez que se modifica la lista
+            for guild in [guild for guild in bot.guilds if guild.shard_id == shard_id]:
+                presencia.sembrar(guild)
+                for sesion in sesiones.abiertas(guild.id):
+                    # Actualizar el embed
+                    if reconciliar_sesion(sesion, guild) and sesion.actualizador.iniciado:
+                        sesion.actualizador.solicitar()
+                await asyncio.sleep(0)  # Dejar pasar los eventos de otros guilds entre uno y otro
 
-        # Actualizar el embed
-        if embed_main_message or embed_reservas_message:
-            await actualizar_embeds(bot.get_channel(int(config['channel_default'])))
+resincronizador_presencia = ResincronizadorPresencia()
 
 #################################################################################################
 
-bot.run(config['token'], reconnect=True)
+if __name__ == "__main__":
+    bot.run(config['token'], reconnect=True, log_handler=None)  # El logging ya esta configurado arriba
+    db.cerrar()
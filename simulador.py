@@ -0,0 +1,483 @@
+"""
+Simulador sin conexion del bot de eventos.
+
+Sustituye a Discord por un guild falso (miembros, canales de voz y de texto) y un registro de
+llamadas REST, y reproduce sobre main.py una lista completa: NewList, una tormenta de entradas
+y salidas de voz (aleatoria o leida de un guion JSON) y el cierre. Al terminar muestra las
+llamadas REST hechas, las ediciones por segundo, la latencia entre un evento de voz y el
+embed que lo refleja y el tiempo pasado en la base de datos.
+
+Con --shards N se montan N guilds, cada uno en su propio shard y con su propia lista, que reciben
+su tormenta a la vez; a mitad de la tormenta se reanuda el shard 0 para comprobar que su
+resincronizacion no retrasa a los demas. La latencia se muestra tambien por shard.
+
+Uso:
+    python simulador.py --jugadores 50 --duracion 10
+    python simulador.py --jugadores 50 --shards 4
+    python simulador.py --guion guion.json --json > resultado.json
+
+El guion es una lista de eventos {"t": segundos, "jugador": indice, "tipo": "entra" | "sale"}.
+La base de datos es una copia temporal de control_eventos.db; la original no se toca.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+GUILD_ID = 1
+CANAL_LISTAS = 10
+CANAL_ADMIN = 11
+ROL_JUGADORES = 20
+ROL_ADMINS = 21
+VOZ_PARTIDA = 30
+VOZ_RESERVAS = 31
+SEPARACION_IDS = 100  # Los canales del guild n tienen los ids de arriba mas n * SEPARACION_IDS
+
+#################################################################################################
+
+def preparar_entorno(jugadores_max, ligero, shards):
+    """Configura main.py con valores falsos y una copia temporal de la base de datos."""
+    directorio = tempfile.mkdtemp(prefix="simulador_")
+    database_file = os.path.join(directorio, "control_eventos.db")
+    shutil.copy(os.path.join(DIRECTORIO, "control_eventos.db"), database_file)
+    os.environ.update({
+        "DISCORD_TOKEN": "simulador",
+        "APPLICATION_ID": "1",
+        "CHANNEL_DEFAULT": str(CANAL_LISTAS),
+        "CHANNEL_ADMIN": str(CANAL_ADMIN),
+        "THREAD_STATS_NAME": "stats",
+        "ROL_JUGADORES": str(ROL_JUGADORES),
+        "ROL_ADMINS": str(ROL_ADMINS),
+        "VOICE_CHANNEL_ID": str(VOZ_PARTIDA),
+        "VOICE_CHANNEL_RESERVAS_ID": str(VOZ_RESERVAS),
+        "MAX_PLAYERS": str(jugadores_max),
+        "MAX_TIME": "3600",
+        "SEND_MESSAGES": "true",
+        "EXTRA_CHANNELS": ",".join(str(CANAL_LISTAS + n * SEPARACION_IDS) for n in range(1, shards)),
+        "DATABASE_FILE": database_file,
+        "LOG_FILE": os.path.join(directorio, "bot.log"),
+        "LEAN_MEMBERS": str(ligero).lower(),
+        "SHARDING": str(shards > 1).lower(),
+        "SHARD_COUNT": str(shards),
+    })
+    return directorio
+
+class RegistroREST:
+    """Apunta cada llamada que el bot haria a la API de Discord y simula su latencia."""
+
+    def __init__(self, latencia):
+        self.latencia = latencia
+        self.llamadas = []  # (momento, metodo)
+
+    async def llamada(self, metodo):
+        self.llamadas.append((time.perf_counter(), metodo))
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+
+    def por_metodo(self):
+        cantidades = {}
+        for _, metodo in self.llamadas:
+            cantidades[metodo] = cantidades.get(metodo, 0) + 1
+        return cantidades
+
+class Objeto:
+    """Base de los objetos falsos: ids unicos y comparables como los de discord.py."""
+
+    _ids = itertools.count(1000)
+
+    def __init__(self, id=None):
+        self.id = id if id is not None else next(self._ids)
+
+    def __eq__(self, otro):
+        return isinstance(otro, Objeto) and otro.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class Mensaje(Objeto):
+    def __init__(self, simulador, canal, content=None, embed=None):
+        super().__init__()
+        self.simulador = simulador
+        self.channel = canal
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        inicio = time.perf_counter()
+        await self.simulador.rest.llamada("editar mensaje")
+        if embed is not None:
+            self.embeds = [embed]
+            self.simulador.registrar_pintado(inicio)
+        if content is not None:
+            self.content = content
+
+    async def delete(self):
+        await self.simulador.rest.llamada("borrar mensaje")
+
+class Canal(Objeto):
+    def __init__(self, simulador, id, name="canal"):
+        super().__init__(id)
+        self.simulador = simulador
+        self.name = name
+        self.guild = simulador.guild
+        self.mensajes = {}
+        self.threads = []
+        self.archived = False
+
+    async def send(self, content=None, embed=None, **kwargs):
+        await self.simulador.rest.llamada("enviar mensaje")
+        mensaje = Mensaje(self.simulador, self, content, embed)
+        self.mensajes[mensaje.id] = mensaje
+        return mensaje
+
+    async def fetch_message(self, mensaje_id):
+        await self.simulador.rest.llamada("leer mensaje")
+        return self.mensajes[mensaje_id]
+
+    def get_partial_message(self, mensaje_id):
+        return self.mensajes.get(mensaje_id) or Mensaje(self.simulador, self)
+
+    async def create_thread(self, name, **kwargs):
+        await self.simulador.rest.llamada("crear hilo")
+        hilo = Canal(self.simulador, None, name)
+        self.threads.append(hilo)
+        self.guild.hilos[hilo.id] = hilo
+        return hilo
+
+    async def delete_messages(self, mensajes):
+        await self.simulador.rest.llamada("borrar mensajes en bloque")
+
+    def history(self, limit=None, after=None):
+        async def vacio():
+            return
+            yield
+        return vacio()
+
+class CanalVoz(Objeto):
+    def __init__(self, id):
+        super().__init__(id)
+        self.members = []
+
+class EstadoVoz:
+    def __init__(self, channel):
+        self.channel = channel
+
+class CanalDM:
+    def __init__(self, simulador):
+        self.simulador = simulador
+
+    async def send(self, **kwargs):
+        await self.simulador.rest.llamada("enviar mensaje privado")
+
+class Rol(Objeto):
+    def __init__(self, id):
+        super().__init__(id)
+        self.members = []
+
+class Miembro(Objeto):
+    def __init__(self, simulador, nombre, roles):
+        super().__init__()
+        self.simulador = simulador
+        self.guild = simulador.guild
+        self.name = nombre
+        self.display_name = nombre
+        self.global_name = nombre
+        self.roles = roles
+        self.mutual_guilds = [simulador.guild]
+
+    def get_role(self, rol_id):
+        return next((rol for rol in self.roles if rol.id == rol_id), None)
+
+    async def create_dm(self):
+        await self.simulador.rest.llamada("crear DM")
+        return CanalDM(self.simulador)
+
+class Guild(Objeto):
+    def __init__(self, simulador, id=GUILD_ID, shard_id=0):
+        super().__init__(id)
+        self.simulador = simulador
+        self.shard_id = shard_id
+        self.name = f"Simulador {shard_id}"
+        self.unavailable = False
+        self.miembros = {}
+        self.roles = {}
+        self.voice_channels = []
+        self.hilos = {}
+
+    def get_member(self, member_id):
+        return self.miembros.get(member_id)
+
+    def get_role(self, rol_id):
+        return self.roles.get(rol_id)
+
+    def get_thread(self, thread_id):
+        return self.hilos.get(thread_id)
+
+    async def query_members(self, query=None, limit=5, user_ids=None, cache=True):
+        await self.simulador.rest.llamada("buscar miembros")
+        if user_ids is not None:
+            return [self.miembros[member_id] for member_id in user_ids if member_id in self.miembros]
+        encontrados = [m for m in self.miembros.values() if m.name.startswith(query) or m.display_name.startswith(query)]
+        return encontrados[:limit]
+
+class Respuesta:
+    def __init__(self):
+        self.hecha = False
+
+    def is_done(self):
+        return self.hecha
+
+    async def send_message(self, *args, **kwargs):
+        self.hecha = True
+
+    async def defer(self, *args, **kwargs):
+        self.hecha = True
+
+class Seguimiento:
+    async def send(self, *args, **kwargs):
+        pass
+
+class Interaccion:
+    def __init__(self, simulador, usuario, canal):
+        self.user = usuario
+        self.guild = simulador.guild
+        self.guild_id = simulador.guild.id
+        self.channel = canal
+        self.channel_id = canal.id
+        self.response = Respuesta()
+        self.followup = Seguimiento()
+
+#################################################################################################
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+class ServidorSimulado:
+    """
+    Un guild falso con sus canales, sus miembros y su tormenta de voz. Los objetos falsos lo reciben
+    como `simulador`: de el toman el guild, el registro REST compartido y donde apuntar los pintados.
+    """
+
+    def __init__(self, simulador, indice, jugadores):
+        self.rest = simulador.rest
+        separacion = indice * SEPARACION_IDS
+        self.guild = Guild(self, GUILD_ID + indice, shard_id=indice)
+        self.eventos = []  # momentos de los eventos de voz aun no reflejados en un embed
+        self.latencias = []
+        self.pintados = []  # momentos de las ediciones de embeds
+
+        # Los roles tienen el mismo id en todos los guilds porque main.py solo admite uno configurado
+        rol_jugadores, rol_admins = Rol(ROL_JUGADORES), Rol(ROL_ADMINS)
+        self.guild.roles = {rol.id: rol for rol in (rol_jugadores, rol_admins)}
+        self.voz_partida = CanalVoz(VOZ_PARTIDA + separacion)
+        self.guild.voice_channels = [self.voz_partida, CanalVoz(VOZ_RESERVAS + separacion)]
+        self.canal_listas = Canal(self, CANAL_LISTAS + separacion)
+        self.canales = {self.canal_listas.id: self.canal_listas}
+        if indice == 0:
+            self.canales[CANAL_ADMIN] = Canal(self, CANAL_ADMIN)
+        self.admin = Miembro(self, "admin", [rol_admins])
+        self.jugadores = [Miembro(self, f"jugador{n:03d}", [rol_jugadores]) for n in range(jugadores)]
+        for miembro in [self.admin] + self.jugadores:
+            self.guild.miembros[miembro.id] = miembro
+        rol_jugadores.members = list(self.jugadores)
+
+    def registrar_pintado(self, inicio):
+        # Un evento queda reflejado si ocurrio antes de que empezara la edicion que lo pinta
+        self.pintados.append(inicio)
+        fin = time.perf_counter()
+        pendientes = []
+        for momento in self.eventos:
+            if momento <= inicio:
+                self.latencias.append(fin - momento)
+            else:
+                pendientes.append(momento)
+        self.eventos = pendientes
+
+    async def evento_voz(self, main, miembro, tipo):
+        conectado = miembro in self.voz_partida.members
+        antes = EstadoVoz(self.voz_partida if conectado else None)
+        if (tipo == "entra") == conectado:
+            return
+        if tipo == "entra":
+            self.voz_partida.members.append(miembro)
+            despues = EstadoVoz(self.voz_partida)
+        else:
+            self.voz_partida.members.remove(miembro)
+            despues = EstadoVoz(None)
+        self.eventos.append(time.perf_counter())
+        await main.on_voice_state_update(miembro, antes, despues)
+
+    async def tormenta(self, main, guion, inicio_tormenta):
+        for momento, indice, tipo in guion:
+            espera = inicio_tormenta + momento - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            await self.evento_voz(main, self.jugadores[indice], tipo)
+
+class Simulador:
+    """Monta los guilds falsos, conecta main.py a ellos y reproduce los eventos."""
+
+    def __init__(self, main, jugadores, latencia, shards=1):
+        self.main = main
+        self.rest = RegistroREST(latencia)
+        self.servidores = [ServidorSimulado(self, indice, jugadores) for indice in range(shards)]
+
+        canales = {canal_id: canal for servidor in self.servidores for canal_id, canal in servidor.canales.items()}
+        guilds = {servidor.guild.id: servidor.guild for servidor in self.servidores}
+        bot = main.bot
+        bot.get_channel = lambda canal_id: canales.get(canal_id) or next(
+            (guild.hilos[canal_id] for guild in guilds.values() if canal_id in guild.hilos), None)
+        bot.get_guild = guilds.get
+        bot.get_user = lambda user_id: next(
+            (guild.get_member(user_id) for guild in guilds.values() if guild.get_member(user_id)), None)
+        bot._connection._guilds = guilds  # bot.guilds, que recorre el resincronizador de presencia
+
+    async def ejecutar(self, guiones):
+        main = self.main
+        main.bot.loop = asyncio.get_running_loop()
+        await main.inicializar_db()
+        for servidor in self.servidores:
+            main.presencia.sembrar(servidor.guild)
+            if not main.MODO_LIGERO:  # En modo ligero el indice empieza vacio y se llena con busquedas
+                main.indices_nombres.de(servidor.guild.id).reconstruir(servidor.guild)
+
+        inicio = time.perf_counter()
+        for servidor in self.servidores:
+            await main.crear_lista(Interaccion(servidor, servidor.admin, servidor.canal_listas), "\n".join(j.name for j in servidor.jugadores))
+        alta = time.perf_counter() - inicio
+
+        inicio_tormenta = time.perf_counter()
+        duracion_guion = max(guion[-1][0] for guion in guiones)
+        if len(self.servidores) > 1:
+            # Un shard se reanuda a mitad de la tormenta: solo sus guilds se deben resincronizar
+            asyncio.get_running_loop().call_later(duracion_guion / 2, lambda: asyncio.create_task(main.on_shard_resumed(0)))
+        await asyncio.gather(*(servidor.tormenta(main, guion, inicio_tormenta) for servidor, guion in zip(self.servidores, guiones)))
+        # Dejar que la ultima rafaga llegue a los embeds
+        while any(servidor.eventos for servidor in self.servidores) and time.perf_counter() - inicio_tormenta < duracion_guion + 10:
+            await asyncio.sleep(0.1)
+        duracion_tormenta = time.perf_counter() - inicio_tormenta
+        await main.despachador_mensajes.cola.join()
+        ediciones_tormenta = sum(1 for servidor in self.servidores for momento in servidor.pintados if momento >= inicio_tormenta)
+
+        inicio_cierre = time.perf_counter()
+        for servidor in self.servidores:
+            await main.cerrar_lista(main.sesiones.obtener(servidor.guild.id, servidor.canal_listas.id))
+        await main.diario_sesiones.volcar()
+        cierre = time.perf_counter() - inicio_cierre
+
+        latencias = sorted(latencia for servidor in self.servidores for latencia in servidor.latencias)
+        return {
+            "shards": len(self.servidores),
+            "jugadores": sum(len(servidor.jugadores) for servidor in self.servidores),
+            "eventos_voz": sum(len(guion) for guion in guiones),
+            "eventos_sin_pintar": sum(len(servidor.eventos) for servidor in self.servidores),
+            "segundos_alta_lista": round(alta, 4),
+            "segundos_tormenta": round(duracion_tormenta, 2),
+            "segundos_cierre": round(cierre, 4),
+            "llamadas_rest": len(self.rest.llamadas),
+            "llamadas_rest_por_metodo": self.rest.por_metodo(),
+            "ediciones_por_segundo": round(ediciones_tormenta / duracion_tormenta, 3) if duracion_tormenta else 0,
+            "latencia_ms": resumen_latencias(latencias),
+            "latencia_ms_por_shard": [resumen_latencias(sorted(servidor.latencias)) for servidor in self.servidores],
+            "db_ms_total": round(sum(n * media for _, n, media, _ in main.db.estadisticas()), 2),
+            "db_consultas": [
+                {"consulta": consulta[:80], "n": n, "media_ms": round(media, 3), "max_ms": round(maximo, 3)}
+                for consulta, n, media, maximo in main.db.estadisticas()[:10]
+            ],
+        }
+
+def resumen_latencias(latencias):
+    return {
+        "p50": round(percentil(latencias, 0.5) * 1000, 1),
+        "p95": round(percentil(latencias, 0.95) * 1000, 1),
+        "p99": round(percentil(latencias, 0.99) * 1000, 1),
+        "max": round((latencias[-1] if latencias else 0) * 1000, 1),
+    }
+
+#################################################################################################
+
+def guion_aleatorio(jugadores, duracion, semilla, rebotes):
+    """
+    Todos los jugadores entran en voz en un momento aleatorio dentro de la duracion; una parte
+    sale y vuelve a entrar poco despues (rebotes) para ensuciar la rafaga.
+    """
+    aleatorio = random.Random(semilla)
+    eventos = []
+    for indice in range(jugadores):
+        momento = aleatorio.uniform(0, duracion)
+        eventos.append((momento, indice, "entra"))
+        if aleatorio.random() < rebotes:
+            salida = min(duracion, momento + aleatorio.uniform(0.1, 2))
+            eventos.append((salida, indice, "sale"))
+            eventos.append((min(duracion, salida + aleatorio.uniform(0.1, 2)), indice, "entra"))
+    return sorted(eventos)
+
+def cargar_guion(ruta):
+    with open(ruta, encoding="utf-8") as fichero:
+        return sorted((evento["t"], evento["jugador"], evento["tipo"]) for evento in json.load(fichero))
+
+def mostrar(resultado):
+    print(f"Shards: {resultado['shards']} | Jugadores: {resultado['jugadores']} | Eventos de voz: {resultado['eventos_voz']} | Sin pintar: {resultado['eventos_sin_pintar']}")
+    print(f"Alta de la lista: {resultado['segundos_alta_lista']}s | Tormenta: {resultado['segundos_tormenta']}s | Cierre: {resultado['segundos_cierre']}s")
+    print(f"Llamadas REST: {resultado['llamadas_rest']}")
+    for metodo, cantidad in sorted(resultado["llamadas_rest_por_metodo"].items()):
+        print(f"  {metodo:<28} {cantidad:>6}")
+    print(f"Ediciones de embeds por segundo: {resultado['ediciones_por_segundo']}")
+    latencia = resultado["latencia_ms"]
+    print(f"Latencia evento -> embed: p50 {latencia['p50']} ms | p95 {latencia['p95']} ms | p99 {latencia['p99']} ms | máx {latencia['max']} ms")
+    if resultado["shards"] > 1:
+        for shard, latencia in enumerate(resultado["latencia_ms_por_shard"]):
+            print(f"  shard {shard}: p50 {latencia['p50']} ms | p95 {latencia['p95']} ms | máx {latencia['max']} ms")
+    print(f"Tiempo en la base de datos: {resultado['db_ms_total']} ms")
+    for consulta in resultado["db_consultas"]:
+        print(f"  {consulta['consulta']:<80} {consulta['n']:>5} {consulta['media_ms']:>9.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulador sin conexion del bot de eventos")
+    parser.add_argument("--jugadores", type=int, default=50)
+    parser.add_argument("--duracion", type=float, default=10, help="Segundos en los que entran todos los jugadores")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--rebotes", type=float, default=0.2, help="Fraccion de jugadores que salen y vuelven a entrar")
+    parser.add_argument("--latencia-rest", type=float, default=0.05, help="Segundos que tarda cada llamada REST simulada")
+    parser.add_argument("--guion", help="Fichero JSON con los eventos de voz en lugar de generarlos")
+    parser.add_argument("--ligero", action="store_true", help="Simular el modo LEAN_MEMBERS, buscando los miembros bajo demanda")
+    parser.add_argument("--shards", type=int, default=1, help="Guilds simulados, cada uno en su propio shard")
+    parser.add_argument("--json", action="store_true", help="Mostrar el resultado en JSON para comparar ejecuciones")
+    args = parser.parse_args()
+
+    directorio = preparar_entorno(args.jugadores, args.ligero, args.shards)
+    sys.path.insert(0, DIRECTORIO)
+    # Los mensajes del bot van a stderr para que el informe se pueda leer o guardar aparte
+    with contextlib.redirect_stdout(sys.stderr):
+        import main as bot_eventos
+
+        if args.guion:
+            guiones = [cargar_guion(args.guion)] * args.shards
+        else:
+            guiones = [guion_aleatorio(args.jugadores, args.duracion, args.semilla + shard, args.rebotes) for shard in range(args.shards)]
+        simulador = Simulador(bot_eventos, args.jugadores, args.latencia_rest, args.shards)
+        try:
+            resultado = asyncio.run(simulador.ejecutar(guiones))
+        finally:
+            bot_eventos.db.cerrar()
+            shutil.rmtree(directorio, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    else:
+        mostrar(resultado)
+
+if __name__ == "__main__":
+    main()